@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Measure the delivery latency of the invalidation bus.
+
+It forks some subscriber processes, each running an IOLoop with a bus, then
+publishes messages from this process and prints the percentiles of the
+seconds between publishing and receiving them.
+
+Usage:
+    python bench/bus_latency.py [subscribers] [messages]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tornado import ioloop
+
+from blog import bus
+
+
+def subscriber(directory, messages, result):
+    """Receive the messages and write the latencies to the result file."""
+    io_loop = ioloop.IOLoop()
+    latencies = []
+
+    def on_message(sent_time):
+        latencies.append(time.time() - sent_time)
+        if len(latencies) == messages:
+            io_loop.stop()
+
+    receiver = bus.InvalidationBus(directory)
+    receiver.subscribe('bench', on_message)
+    receiver.start(io_loop)
+    io_loop.start()
+    receiver.close()
+    with open(result, 'w') as f:
+        f.write('\n'.join(repr(latency) for latency in latencies))
+
+
+def percentile(values, fraction):
+    """Return the value at the fraction of the sorted values."""
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def main():
+    subscribers = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    messages = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    directory = tempfile.mkdtemp()
+    try:
+        pids = []
+        for i in range(subscribers):
+            result = os.path.join(directory, 'result-{0}'.format(i))
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    subscriber(directory, messages, result)
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+
+        #Wait for the subscribers to bind their sockets.
+        while len([name for name in os.listdir(directory)
+                   if name.endswith('.sock')]) < subscribers:
+            time.sleep(0.01)
+
+        publisher = bus.InvalidationBus(directory)
+        publisher.start(ioloop.IOLoop())
+        for i in range(messages):
+            publisher.publish('bench', time.time())
+            #Publishing is rare in the blog, don't fill the socket buffers.
+            time.sleep(0.0005)
+        stats = publisher.stats()
+        publisher.close()
+        for pid in pids:
+            os.waitpid(pid, 0)
+
+        latencies = []
+        for i in range(subscribers):
+            with open(os.path.join(directory, 'result-{0}'.format(i))) as f:
+                latencies.extend(float(line) for line in f if line.strip())
+        latencies.sort()
+        print 'subscribers: {0}, messages: {1}, sent: {2}, dropped: {3}'.format(
+            subscribers, messages, stats['sent'], stats['dropped'])
+        for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99)):
+            print '{0}: {1:8.1f} us'.format(
+                name, percentile(latencies, fraction) * 1e6)
+        print 'max: {0:8.1f} us'.format(latencies[-1] * 1e6)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
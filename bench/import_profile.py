@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Report what importing the blog costs, module by module.
+
+It imports the target modules (server and migrate by default) with a timed
+__import__, then prints the modules taking the most time by themselves
+(without the modules they import) and the total. It also checks importing
+has no side effect: the config isn't loaded, and no engine, executor or
+context is created.
+
+It exits with 1 if a check fails or the total is over --max-ms, so it can
+run in CI.
+
+Usage:
+    python bench/import_profile.py [--top N] [--max-ms MS] [module ...]
+"""
+
+import __builtin__
+import argparse
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class ImportTimer(object):
+    """Time the imports and tell the time to the modules they create."""
+    def __init__(self):
+        self.original_import = __builtin__.__import__
+        #The modules created by the imports running, and the time of their
+        #nested imports.
+        self.stack = []
+        #The module name to (self seconds, total seconds).
+        self.times = {}
+
+    def install(self):
+        __builtin__.__import__ = self.timed_import
+
+    def uninstall(self):
+        __builtin__.__import__ = self.original_import
+
+    def timed_import(self, name, globals=None, locals=None, fromlist=None,
+                     level=-1):
+        before = set(sys.modules)
+        self.stack.append([0.0, set()])
+        start = time.time()
+        try:
+            return self.original_import(name, globals, locals, fromlist,
+                                        level)
+        finally:
+            seconds = time.time() - start
+            nested_seconds, nested_modules = self.stack.pop()
+            new = set(key for key in sys.modules
+                      if key not in before and sys.modules[key] is not None)
+            own = new - nested_modules
+            if own:
+                #Only the first import of a module costs, the others hit
+                #sys.modules.
+                label = min(own, key=len)
+                self.times[label] = (seconds - nested_seconds, seconds)
+            if self.stack:
+                self.stack[-1][0] += seconds
+                self.stack[-1][1].update(new)
+
+
+def check_side_effects():
+    """Return the list of the side effects found after the imports."""
+    problems = []
+    options_module = sys.modules.get('blog.options')
+    if options_module is not None and options_module.loaded_path is not None:
+        problems.append('the config is loaded')
+    model = sys.modules.get('blog.model')
+    if model is not None:
+        if model.engine is not None:
+            problems.append('the engine is created')
+        if model.executor is not None:
+            problems.append('the database executor is created')
+    context = sys.modules.get('blog.context')
+    if context is not None and context.context:
+        problems.append('the context is created')
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Report the import time of the blog by module.')
+    parser.add_argument('modules', nargs='*', default=['server', 'migrate'],
+                        help='The modules to import.')
+    parser.add_argument('--top', type=int, default=25,
+                        help='How many modules to list.')
+    parser.add_argument('--max-ms', type=float, default=None,
+                        help='Fail if importing takes longer.')
+    args = parser.parse_args()
+
+    sys.path.insert(0, ROOT)
+    timer = ImportTimer()
+    timer.install()
+    start = time.time()
+    try:
+        for name in args.modules:
+            __import__(name)
+    finally:
+        timer.uninstall()
+    total = time.time() - start
+
+    print '{0:>10} {1:>10}  {2}'.format('self ms', 'total ms', 'module')
+    ranked = sorted(timer.times.items(), key=lambda item: -item[1][0])
+    for name, (own, seconds) in ranked[:args.top]:
+        print '{0:>10.2f} {1:>10.2f}  {2}'.format(own * 1000, seconds * 1000,
+                                                  name)
+    blog_seconds = sum(own for name, (own, seconds) in timer.times.items()
+                       if name == 'blog' or name.startswith('blog.'))
+    print 'modules: {0}, total: {1:.1f} ms, blog itself: {2:.1f} ms'.format(
+        len(timer.times), total * 1000, blog_seconds * 1000)
+
+    failed = False
+    for problem in check_side_effects():
+        print 'FAIL: {0} by importing.'.format(problem)
+        failed = True
+    if args.max_ms is not None and total * 1000 > args.max_ms:
+        print 'FAIL: importing takes {0:.1f} ms, over {1:.1f} ms.'.format(
+            total * 1000, args.max_ms)
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
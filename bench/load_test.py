@@ -0,0 +1,450 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Measure the throughput and latency of every route of the blog.
+
+It generates a synthetic blog (users, articles of markdown and comments)
+into a new SQLite database, or into the empty database of --db-url such as
+a local MySQL, serves the Application in this process like server.py does,
+and sends the requests of every route at a fixed concurrency, one route
+after another. The requests per second and the latency percentiles of
+every route are printed as JSON, so the results of two versions can be
+compared. They count the successful responses only (2xx and 3xx, or the
+expected 404 of not_found). A route with any other response is marked
+failed, and the run exits with status 1.
+
+The templates must be in blog/templates.
+
+The client runs on the same IOLoop as the server, so the numbers include
+its cost. Compare the runs on the same machine with the same arguments.
+
+Usage:
+    python bench/load_test.py [--db-url URL] [--users N] [--articles N]
+        [--comments N] [--requests N] [--concurrency N] [--seed N]
+        [--route NAME ...]
+        [--set OPTION=VALUE ...] [--output FILE]
+"""
+
+import argparse
+import ast
+import base64
+import datetime
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import urllib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from tornado import gen
+from tornado import httpclient
+from tornado import httpserver
+from tornado import ioloop
+from tornado import testing
+
+import blog
+from blog import application
+from blog import context
+from blog import model
+from blog import passwords
+from blog.options import options
+
+import migrate
+import server
+
+
+#The password of every synthetic user.
+PASSWORD = 'password'
+#The templates rendered by the routes.
+TEMPLATES = ('article.tpl', 'article_list.tpl', 'article_submit.failed.tpl',
+             'article_submit.successful.tpl', 'article_submit.tpl',
+             'comment_submit.failed.tpl', 'comment_submit.successful.tpl',
+             'login.failed.tpl', 'login.successful.tpl', 'login.tpl',
+             'logout.successful.tpl', 'register.failed.tpl',
+             'register.successful.tpl', 'register.tpl', 'user_info.tpl')
+#The error codes expected by the routes, besides the 2xx and 3xx.
+EXPECTED_CODES = {'not_found': (404, )}
+#The words of the synthetic articles and comments.
+WORDS = ('tornado blog article comment python database index query cache '
+         'session template markdown server worker latency request response '
+         'user page cursor engine pool thread loop socket keyset memory '
+         'profile metric replica commit schema migration deploy').split()
+
+
+def sentence(rng, words):
+    """Return a sentence of about words words."""
+    chosen = [rng.choice(WORDS) for i in range(max(1, words))]
+    return ' '.join(chosen).capitalize() + '.'
+
+
+def paragraph(rng):
+    """Return a paragraph with some inline markdown."""
+    parts = [sentence(rng, rng.randint(6, 16)) for i in range(rng.randint(2, 5))]
+    word = rng.choice(WORDS)
+    parts.append(rng.choice(('*{0}*', '**{0}**', '`{0}`',
+                             '[{0}](http://example.com/{0})')).format(word))
+    return ' '.join(parts)
+
+
+def article_markdown(rng):
+    """Return a synthetic article with headings, lists and code."""
+    blocks = ['# ' + sentence(rng, 4)]
+    for i in range(rng.randint(3, 8)):
+        blocks.append(paragraph(rng))
+        if rng.random() < 0.3:
+            blocks.append('## ' + sentence(rng, 3))
+        if rng.random() < 0.3:
+            blocks.append('\n'.join('* ' + sentence(rng, 5)
+                                    for j in range(rng.randint(2, 5))))
+        if rng.random() < 0.2:
+            blocks.append('\n'.join('    {0} = {1}()'.format(
+                rng.choice(WORDS), rng.choice(WORDS))
+                for j in range(rng.randint(2, 6))))
+    return '\n\n'.join(blocks)
+
+
+def generate(args, rng):
+    """Fill the database with the synthetic blog.
+
+    The first user is the host, who can submit articles and use the admin
+    pages. The comments go to the newer articles more, like the real ones.
+    return(dict):
+        The emails of the users, the ids of the users and the title_for_url
+        of the articles.
+    """
+    password_hash = passwords.hash_password(PASSWORD,
+                                            options.password_algorithm,
+                                            options.password_iterations)
+    start = datetime.datetime(2013, 9, 14)
+    users = []
+    for i in range(args.users):
+        user = model.User('user{0}@example.com'.format(i), None,
+                          'user{0}'.format(i), '127.0.0.1',
+                          status='host' if i == 0 else 'user',
+                          register_time=start,
+                          password_hash=password_hash)
+        user.track()
+        users.append(user)
+    model.commit()
+
+    articles = []
+    for i in range(args.articles):
+        article = model.Article(title=sentence(rng, 4)[:100] + ' ' + str(i),
+                                title_for_url='a{0}'.format(i),
+                                raw=article_markdown(rng),
+                                author=users[0],
+                                submit_time=start + datetime.timedelta(
+                                    hours=i))
+        article.track()
+        articles.append(article)
+        if len(articles) % 200 == 0:
+            model.commit()
+    model.commit()
+
+    for i in range(args.comments):
+        #Skewed to the newer articles.
+        index = int(len(articles) * (1 - rng.random() ** 2))
+        comment = model.Comment(raw=paragraph(rng),
+                                author=rng.choice(users),
+                                article=articles[min(index,
+                                                     len(articles) - 1)])
+        comment.track()
+        if i % 500 == 499:
+            model.commit()
+    model.commit()
+
+    dataset = dict(emails=[user.email for user in users],
+                   user_ids=[user.id for user in users],
+                   titles=[article.title_for_url for article in articles])
+    model.session.remove()
+    return dataset
+
+
+def routes(dataset, rng, counter):
+    """Return the routes as a list of (name, request factory, logged in).
+
+    A factory returns (method, path, body) of the next request. The route
+    names are the names of the urls in blog/urls.py, with a suffix for the
+    variants.
+    """
+    titles = dataset['titles']
+    pages = max(1, (len(titles) + 19) // 20)
+
+    def get(path):
+        return lambda: ('GET', path() if callable(path) else path, None)
+
+    def post(path, body):
+        return lambda: ('POST', path, urllib.urlencode(body()))
+
+    def unique():
+        counter[0] += 1
+        return counter[0]
+
+    return [
+        ('home', get('/'), False),
+        ('articlesf', get('/articles/'), False),
+        ('articles', get(lambda: '/articles/{0}/'.format(
+            rng.randint(1, pages))), False),
+        ('article', get(lambda: '/article/{0}/'.format(
+            rng.choice(titles))), False),
+        ('article.logged_in', get(lambda: '/article/{0}/'.format(
+            rng.choice(titles))), True),
+        ('articlesf.logged_in', get('/articles/'), True),
+        ('user', get(lambda: '/user/{0}/'.format(
+            rng.choice(dataset['user_ids']))), False),
+        ('self', get('/user/'), True),
+        ('login', get('/login/'), False),
+        ('login.post', post('/login/', lambda: dict(
+            email=rng.choice(dataset['emails']), password=PASSWORD)), False),
+        ('logout', get('/logout/'), False),
+        ('register', get('/register/'), False),
+        ('register.post', post('/register/', lambda: dict(
+            email='new{0}@example.com'.format(unique()),
+            nickname='new{0}'.format(counter[0]),
+            password=PASSWORD)), False),
+        ('submit_article', get('/submit/article/'), True),
+        ('submit_article.post', post('/submit/article/', lambda: dict(
+            title='New article {0}'.format(unique()),
+            title_for_url='new{0}'.format(counter[0]),
+            content=article_markdown(rng))), True),
+        ('submit_comment.post', post('/submit/comment/', lambda: dict(
+            title_for_url=rng.choice(titles),
+            content=paragraph(rng))), True),
+        ('admin_metrics', get('/admin/metrics/'), True),
+        ('admin_slow_queries', get('/admin/slow-queries/'), True),
+        ('admin_profiles', get('/admin/profiles/'), True),
+        ('admin_memory', get('/admin/memory/'), True),
+        ('not_found', get('/no/such/page/'), False),
+    ]
+
+
+def percentile(values, fraction):
+    """Return the value at the fraction of the sorted values."""
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+@gen.coroutine
+def run_route(client, base_url, factory, cookie, requests, concurrency,
+              expected=()):
+    """Send requests requests of a route by concurrency clients.
+
+    args:
+        expected(tuple of int, default=()):
+            The error codes counted as successful, besides 2xx and 3xx.
+    return(dict):
+        The requests, the status codes, the errors, if the route failed (any
+        error), and the requests per second and the latency percentiles in
+        milliseconds of the successful responses (None if there is none).
+    """
+    latencies = []
+    codes = {}
+    errors = [0]
+    remaining = [requests]
+
+    @gen.coroutine
+    def worker():
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            method, path, body = factory()
+            headers = {'Cookie': cookie} if cookie else {}
+            request = httpclient.HTTPRequest(base_url + path, method=method,
+                                             body=body, headers=headers,
+                                             follow_redirects=False)
+            start = time.time()
+            try:
+                response = yield client.fetch(request)
+                code = response.code
+            except httpclient.HTTPError as e:
+                #The redirections and the errors, 599 if there is no
+                #response.
+                code = e.code
+            codes[code] = codes.get(code, 0) + 1
+            if 200 <= code < 400 or code in expected:
+                latencies.append(time.time() - start)
+            else:
+                errors[0] += 1
+
+    start = time.time()
+    yield [worker() for i in range(concurrency)]
+    seconds = time.time() - start
+    latencies.sort()
+    result = dict(
+        requests=requests,
+        codes=dict((str(code), count) for code, count in codes.items()),
+        errors=errors[0],
+        failed=errors[0] > 0,
+        requests_per_second=len(latencies) / seconds,
+        mean_ms=None, p50_ms=None, p95_ms=None, p99_ms=None, max_ms=None,
+    )
+    if latencies:
+        result.update(mean_ms=sum(latencies) / len(latencies) * 1000,
+                      p50_ms=percentile(latencies, 0.5) * 1000,
+                      p95_ms=percentile(latencies, 0.95) * 1000,
+                      p99_ms=percentile(latencies, 0.99) * 1000,
+                      max_ms=latencies[-1] * 1000)
+    raise gen.Return(result)
+
+
+@gen.coroutine
+def run_all(base_url, dataset, args, rng):
+    """Log in as the host, then measure every route."""
+    client = httpclient.AsyncHTTPClient(max_clients=args.concurrency)
+    try:
+        response = yield client.fetch(
+            base_url + '/login/', method='POST', follow_redirects=False,
+            body=urllib.urlencode(dict(email=dataset['emails'][0],
+                                       password=PASSWORD)))
+    except httpclient.HTTPError as e:
+        #Redirected after logging in.
+        if e.response is None:
+            raise
+        response = e.response
+    cookie = '; '.join(value.split(';')[0] for value in
+                       response.headers.get_list('Set-Cookie'))
+    if response.code >= 400 or not cookie:
+        raise RuntimeError('Logging in as the host failed with {0}.'.format(
+            response.code))
+    results = {}
+    counter = [0]
+    for name, factory, logged_in in routes(dataset, rng, counter):
+        if args.routes and name not in args.routes:
+            continue
+        expected = EXPECTED_CODES.get(name, ())
+        #Warm up the route: the page cache, the key index and the pools.
+        yield run_route(client, base_url, factory,
+                        cookie if logged_in else None, args.concurrency,
+                        args.concurrency, expected)
+        results[name] = yield run_route(client, base_url, factory,
+                                        cookie if logged_in else None,
+                                        args.requests, args.concurrency,
+                                        expected)
+    raise gen.Return(results)
+
+
+def write_config(path, directory, settings):
+    """Write the config of the run: blog/config.py (or the sample if there is
+    none) with the settings appended.
+
+    Every host is served, because the requests are sent to 127.0.0.1, and a
+    random cookie_secret is used. The settings can override them.
+    """
+    base = os.path.join(ROOT, 'blog', 'config.py')
+    if not os.path.exists(base):
+        base = base + '.sample'
+    with open(base) as f:
+        content = f.read()
+    lines = [content, '', '#Set by bench/load_test.py.']
+    settings = dict([('bus_dir', os.path.join(directory, 'bus')),
+                     ('template_module_dir',
+                      os.path.join(directory, 'templates')),
+                     ('profile_dir', os.path.join(directory, 'profiles')),
+                     ('session_storage', 'memory'),
+                     ('host_pattern', '.*'),
+                     ('cookie_secret', base64.b64encode(os.urandom(32)))]
+                    + settings)
+    for name, value in sorted(settings.items()):
+        lines.append('{0} = {1!r}'.format(name, value))
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def parse_setting(text):
+    """Parse OPTION=VALUE, the value is a Python literal or a string."""
+    name, value = text.split('=', 1)
+    try:
+        value = ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        pass
+    return (name.strip(), value)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure every route of the blog on a synthetic blog.')
+    parser.add_argument('--db-url', default=None,
+                        help='An empty database to fill, a new SQLite '
+                             'database by default.')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--articles', type=int, default=500)
+    parser.add_argument('--comments', type=int, default=5000)
+    parser.add_argument('--requests', type=int, default=500,
+                        help='How many requests every route gets.')
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--route', dest='routes', action='append',
+                        help='Only measure this route, can be repeated.')
+    parser.add_argument('--set', dest='settings', action='append',
+                        type=parse_setting, default=[],
+                        help='Override an option, such as '
+                             'password_iterations=1000.')
+    parser.add_argument('--output', default=None,
+                        help='Write the JSON to this file.')
+    args = parser.parse_args()
+
+    names = context.template_names()
+    missing = [name for name in TEMPLATES if name not in names]
+    if missing:
+        parser.error('The templates are missing in {0}: {1}'.format(
+            context.TEMPLATE_DIR, ', '.join(missing)))
+
+    rng = random.Random(args.seed)
+    directory = tempfile.mkdtemp()
+    try:
+        db_url = args.db_url or 'sqlite:///{0}'.format(
+            os.path.join(directory, 'blog.sqlite'))
+        config_path = os.path.join(directory, 'config.py')
+        write_config(config_path, directory, args.settings)
+        blog.bootstrap(config_path, db_url=db_url)
+
+        connection = model.get_engine().connect()
+        try:
+            migrate.upgrade(connection)
+        finally:
+            connection.close()
+        start = time.time()
+        dataset = generate(args, rng)
+        generate_seconds = time.time() - start
+
+        io_loop = ioloop.IOLoop.instance()
+        ctx = server.prepare(run_cron=False)
+        try:
+            http_server = httpserver.HTTPServer(
+                application.Application(ctx))
+            sock, port = testing.bind_unused_port()
+            http_server.add_sockets([sock])
+            base_url = 'http://127.0.0.1:{0}'.format(port)
+            results = io_loop.run_sync(
+                lambda: run_all(base_url, dataset, args, rng))
+            http_server.stop()
+        finally:
+            server.clean(ctx)
+
+        report = dict(
+            dataset=dict(users=args.users, articles=args.articles,
+                         comments=args.comments, seed=args.seed,
+                         database=db_url.split(':', 1)[0],
+                         generate_seconds=generate_seconds),
+            requests=args.requests,
+            concurrency=args.concurrency,
+            settings=dict(args.settings),
+            routes=results,
+        )
+        output = json.dumps(report, indent=2, sort_keys=True)
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(output + '\n')
+        print output
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    failed = sorted(name for name, result in results.items()
+                    if result['failed'])
+    if failed:
+        sys.exit('Failed routes: {0}'.format(', '.join(failed)))
+
+
+if __name__ == '__main__':
+    main()
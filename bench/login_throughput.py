@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Measure the login throughput at different password costs.
+
+For every cost, it verifies many passwords at once by a PasswordHasher, like
+a login storm, and prints how many logins per second are verified. At the
+same time a timer runs on the IOLoop every 5ms, and the longest delay of it
+shows if the storm stalls the other requests (such as the article reads).
+
+Usage:
+    python bench/login_throughput.py [logins] [workers]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tornado import gen
+from tornado import ioloop
+
+from blog import passwords
+from blog import utils
+
+
+COSTS = ('legacy', 10000, 50000, 100000, 200000)
+
+
+def run(hasher, encoded, legacy_salts, logins):
+    """Verify the password logins times at once on a new IOLoop.
+
+    return(tuple):
+        (seconds, the longest delay of the 5ms timer in seconds).
+    """
+    io_loop = ioloop.IOLoop()
+    io_loop.make_current()
+    lag = dict(last=None, max=0.0)
+
+    def tick():
+        now = time.time()
+        if lag['last'] is not None:
+            lag['max'] = max(lag['max'], now - lag['last'] - 0.005)
+        lag['last'] = now
+
+    timer = ioloop.PeriodicCallback(tick, 5, io_loop=io_loop)
+
+    @gen.coroutine
+    def storm():
+        futures = [hasher.verify('password', encoded, legacy_salts)
+                   for i in range(logins)]
+        results = yield futures
+        assert all(matched for matched, _ in results)
+
+    timer.start()
+    start = time.time()
+    io_loop.run_sync(storm)
+    seconds = time.time() - start
+    timer.stop()
+    return (seconds, lag['max'])
+
+
+def main():
+    logins = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    legacy_salts = ('2013-09-14 16:29:00', '127.0.0.1')
+    print 'logins: {0}, workers: {1}'.format(logins, workers)
+    print '{0:>8} {1:>8} {2:>12} {3:>12}'.format('cost', 'pool', 'logins/s',
+                                                  'max lag ms')
+    for cost in COSTS:
+        if cost == 'legacy':
+            encoded = utils.hash_repeat('password', *legacy_salts)
+            iterations = 1
+        else:
+            encoded = passwords.hash_password('password', iterations=cost)
+            iterations = cost
+        for use_processes in (False, True):
+            #Verify with the same cost, so nothing is rehashed, except the
+            #legacy hashes.
+            hasher = passwords.PasswordHasher(iterations=iterations,
+                                              workers=workers,
+                                              use_processes=use_processes)
+            #Start the executor before timing.
+            hasher.hash('warm up').result()
+            seconds, lag = run(hasher, encoded, legacy_salts, logins)
+            hasher.shutdown()
+            print '{0:>8} {1:>8} {2:>12.1f} {3:>12.1f}'.format(
+                cost, 'process' if use_processes else 'thread',
+                logins / seconds, lag * 1000)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,398 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Time the hot helper functions and model paths against stored baselines.
+
+Every benchmark is run for at least --min-time seconds, --repeat times, and
+the best time of one operation is kept. The times are divided by the time of
+a fixed pure Python loop run just before, so the baseline saved on one
+machine can be compared on another one roughly, and a machine changing its
+speed meanwhile disturbs the results less. The run fails (exit
+status 1) if a benchmark is slower than its baseline by more than
+--threshold percent. Run it on a quiet machine, a busy or virtual one varies
+by more than the threshold.
+
+Save a new baseline after a change making something slower on purpose, or
+after upgrading Python or the libraries:
+    python bench/micro.py --save
+
+Usage:
+    python bench/micro.py [--baseline FILE] [--save] [--threshold PERCENT]
+        [--repeat N] [--min-time SECONDS] [--sessions N] [--only NAME ...]
+"""
+
+import argparse
+import collections
+import datetime
+import gc
+import json
+import os
+import platform
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from mako import lookup
+from tornado import httpserver
+from tornado import web
+
+import session
+from blog import context
+from blog import model
+from blog import passwords
+from blog import urls
+from blog import utils
+
+
+#Where the baseline is kept.
+BASELINE_PATH = os.path.join(ROOT, 'bench', 'micro_baseline.json')
+#The words of the synthetic articles and comments.
+WORDS = ('tornado blog article comment python database index query cache '
+         'session template markdown server worker latency request').split()
+
+#The name to the function of the benchmarks, in the order they are run.
+benchmarks = collections.OrderedDict()
+
+
+class Skip(Exception):
+    """Raised by a benchmark which can't run in this tree."""
+
+
+def benchmark(name):
+    """Register the function as a benchmark.
+
+    The function gets the number of loops and returns the seconds they took,
+    so it can leave its preparation out of the time.
+    """
+    def register(func):
+        benchmarks[name] = func
+        return func
+    return register
+
+
+def markdown(size, seed=0):
+    """Return a markdown text of about size bytes."""
+    rng = random.Random(seed)
+    blocks = []
+    length = 0
+    while length < size:
+        words = ' '.join(rng.choice(WORDS) for i in range(rng.randint(8, 40)))
+        kind = rng.random()
+        if kind < 0.1:
+            block = '## ' + words[:40]
+        elif kind < 0.2:
+            block = '\n'.join('* ' + word for word in words.split()[:5])
+        elif kind < 0.3:
+            block = '\n'.join('    ' + word + ' = 1'
+                              for word in words.split()[:4])
+        else:
+            block = '{0} *{1}* `{2}` [{1}](http://{2}/).'.format(
+                words.capitalize(), rng.choice(WORDS), rng.choice(WORDS))
+        blocks.append(block)
+        length += len(block) + 2
+    return '\n\n'.join(blocks)
+
+
+def calibrate(loops=100000, repeat=5):
+    """Return the best seconds of a fixed pure Python loop."""
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        table = {}
+        for j in xrange(loops):
+            table[j & 1023] = table.get(j & 1023, 0) + j
+        seconds = time.time() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+@benchmark('utils.hash_repeat')
+def bench_hash_repeat(loops):
+    start = time.time()
+    for i in xrange(loops):
+        utils.hash_repeat('password', '2013-09-14 16:29:00', '127.0.0.1')
+    return time.time() - start
+
+
+@benchmark('utils.content_convert[comment]')
+def bench_convert_comment(loops):
+    raw = markdown(300)
+    start = time.time()
+    for i in xrange(loops):
+        utils.content_convert(raw)
+    return time.time() - start
+
+
+@benchmark('utils.content_convert[100KB article]')
+def bench_convert_article(loops):
+    raw = markdown(100 * 1024)
+    start = time.time()
+    for i in xrange(loops):
+        utils.content_convert(raw)
+    return time.time() - start
+
+
+def application():
+    """Return an Application of the urls, without the context."""
+    return web.Application(urls.urls)
+
+
+@benchmark('utils.create_reverse_url')
+def bench_create_reverse_url(loops):
+    app = application()
+    start = time.time()
+    for i in xrange(loops):
+        utils.create_reverse_url(app, 'http://example.com')
+    return time.time() - start
+
+
+@benchmark('utils.create_reverse_url[call]')
+def bench_reverse_url(loops):
+    reverse_url = utils.create_reverse_url(application(),
+                                           'http://example.com')
+    start = time.time()
+    for i in xrange(loops):
+        reverse_url('article', None, 'title_for_url')
+    return time.time() - start
+
+
+#How many sessions the SessionManager has, set by --sessions.
+session_count = 10 ** 6
+#The session managers filled by session_manager, kept between the
+#benchmarks.
+_managers = {}
+
+
+def session_manager(count):
+    """Return a SessionManager with count sessions, made once."""
+    manager = _managers.get(count)
+    if manager is None:
+        manager = session.SessionManager()
+        expire_time = time.time() + 3600
+        batch = []
+        for i in xrange(count):
+            batch.append(session.Session('key{0}'.format(i), expire_time,
+                                         dict(ip='203.0.113.7', user=i)))
+            if len(batch) == 10000:
+                manager.storage.set_many(batch)
+                batch = []
+        manager.storage.set_many(batch)
+        _managers[count] = manager
+    return manager
+
+
+def session_benchmark(name):
+    """Register a benchmark of the SessionManager with session_count
+    sessions.
+
+    The function gets the manager and the number of loops.
+    """
+    def register(func):
+        def run(loops):
+            return func(session_manager(session_count), loops)
+        benchmarks[name] = run
+        return func
+    return register
+
+
+@session_benchmark('SessionManager.create_session')
+def bench_create_session(manager, loops):
+    created = []
+    start = time.time()
+    for i in xrange(loops):
+        created.append(manager.create_session(dict(ip='203.0.113.7',
+                                                   user=i)))
+    manager.flush()
+    seconds = time.time() - start
+    #Keep the number of sessions for the next runs.
+    for created_session in created:
+        manager.del_session(created_session.key)
+    return seconds
+
+
+@session_benchmark('SessionManager.refresh_session')
+def bench_refresh_session(manager, loops):
+    rng = random.Random(0)
+    keys = ['key{0}'.format(rng.randrange(session_count))
+            for i in xrange(loops)]
+    start = time.time()
+    for key in keys:
+        manager.refresh_session(key)
+    manager.flush()
+    return time.time() - start
+
+
+@session_benchmark('SessionManager.clean_expired_session[1000 expired]')
+def bench_clean_expired_session(manager, loops):
+    seconds = 0
+    for i in xrange(loops):
+        #Older than a slot of the expiry index, so they are found.
+        expire_time = time.time() - 3600
+        manager.storage.set_many(
+            session.Session('expired{0}'.format(j), expire_time)
+            for j in xrange(1000))
+        start = time.time()
+        manager.clean_expired_session()
+        seconds += time.time() - start
+    return seconds
+
+
+@benchmark('mako render article.tpl[1000 comments]')
+def bench_render_article(loops):
+    if not os.path.exists(os.path.join(context.TEMPLATE_DIR, 'article.tpl')):
+        raise Skip('there is no template in {0}'.format(context.TEMPLATE_DIR))
+    template = lookup.TemplateLookup(
+        directories=[context.TEMPLATE_DIR],
+        input_encoding='utf-8',
+    ).get_template('article.tpl')
+    author = model.User('author@example.com', None, 'author', '127.0.0.1',
+                        password_hash='-')
+    article = model.Article('Title', 'title', markdown(10 * 1024),
+                            author=author)
+    comments = []
+    for i in xrange(1000):
+        raw = markdown(200, seed=i)
+        comments.append(model.Comment(raw, author=author, article=article,
+                                      content=utils.content_convert(raw),
+                                      id=i + 1))
+    app = application()
+    namespace = dict(request=httpserver.HTTPRequest('GET', '/article/title/'),
+                     current_user=None,
+                     reverse_url=app.reverse_url,
+                     article=article,
+                     comments=comments,
+                     next_comment=comments[-1].id,
+                     )
+    start = time.time()
+    for i in xrange(loops):
+        template.render(**namespace)
+    return time.time() - start
+
+
+@benchmark('model.User')
+def bench_user(loops):
+    password_hash = passwords.hash_password('password', iterations=1)
+    register_time = datetime.datetime(2013, 9, 14, 16, 29, 0, 123456)
+    start = time.time()
+    for i in xrange(loops):
+        model.User('user@example.com', None, 'user', '127.0.0.1',
+                   register_time=register_time, password_hash=password_hash)
+    return time.time() - start
+
+
+@benchmark('model.Article')
+def bench_article(loops):
+    raw = markdown(10 * 1024)
+    content = utils.content_convert(raw)
+    start = time.time()
+    for i in xrange(loops):
+        model.Article('Title', 'title', raw, content=content)
+    return time.time() - start
+
+
+def measure(func, repeat, min_time):
+    """Return the best seconds of one loop of the benchmark.
+
+    The garbage collector is disabled meanwhile, like timeit does.
+    """
+    gc.disable()
+    try:
+        #Find how many loops take min_time.
+        loops = 1
+        while True:
+            seconds = func(loops)
+            if seconds >= min_time or loops >= 10 ** 7:
+                break
+            loops *= 10 if seconds < min_time / 10 else 2
+        best = seconds / loops
+        for i in range(repeat - 1):
+            best = min(best, func(loops) / loops)
+    finally:
+        gc.enable()
+    return best
+
+
+def load_baseline(path):
+    """Return the baseline saved in the file, or None if there is none."""
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def main():
+    global session_count
+    parser = argparse.ArgumentParser(
+        description='Time the hot paths against the stored baselines.')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save', action='store_true',
+                        help='Save the results as the baseline.')
+    parser.add_argument('--threshold', type=float, default=25,
+                        help='Fail if a benchmark is slower by more than '
+                             'this percent.')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.2)
+    parser.add_argument('--sessions', type=int, default=10 ** 6,
+                        help='The sessions in the SessionManager.')
+    parser.add_argument('--only', action='append',
+                        help='Only run the benchmarks starting with this '
+                             'name, can be repeated.')
+    options = parser.parse_args()
+    session_count = options.sessions
+
+    baseline = load_baseline(options.baseline)
+    #The sessions benchmarks depend on the number of sessions.
+    compare_sessions = (baseline is not None and
+                        baseline.get('sessions') == options.sessions)
+    if baseline is not None and not compare_sessions:
+        print 'The baseline has {0} sessions, not comparing them.'.format(
+            baseline.get('sessions'))
+    results = collections.OrderedDict()
+    regressions = []
+    print '{0:<50} {1:>12} {2:>9}'.format('benchmark', 'us', 'change')
+    for name, func in benchmarks.items():
+        if options.only and not any(name.startswith(prefix)
+                                    for prefix in options.only):
+            continue
+        try:
+            seconds = measure(func, options.repeat, options.min_time)
+        except Skip as e:
+            print '{0:<50} skipped: {1}'.format(name, e)
+            continue
+        results[name] = seconds / calibrate()
+        change = ''
+        old = (baseline or {}).get('benchmarks', {}).get(name)
+        if old is not None and (compare_sessions or
+                                not name.startswith('SessionManager.')):
+            percent = (results[name] / old - 1) * 100
+            change = '{0:+.1f}%'.format(percent)
+            if percent > options.threshold:
+                regressions.append(name)
+                change += ' !'
+        print '{0:<50} {1:>12.2f} {2:>9}'.format(name, seconds * 1e6, change)
+
+    if options.save:
+        if baseline is not None and options.only:
+            #Keep the baselines of the benchmarks not run.
+            baseline['benchmarks'].update(results)
+            results = baseline['benchmarks']
+        with open(options.baseline, 'w') as f:
+            json.dump(dict(python=platform.python_version(),
+                           sessions=options.sessions,
+                           unit='seconds of one loop / seconds of calibrate()',
+                           benchmarks=results,
+                           ), f, indent=2, sort_keys=True)
+            f.write('\n')
+        print 'Saved the baseline to {0}'.format(options.baseline)
+    elif baseline is None:
+        print 'There is no baseline, save one by --save.'
+    if regressions and not options.save:
+        print 'Slower than the baseline by more than {0}%: {1}'.format(
+            options.threshold, ', '.join(regressions))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Measure how many bytes a session takes in the memory storage.
+
+It compares the old representation (a Session with a __dict__, a datetime
+expire_time and an ObjectDict value in a plain dict) with the compact one of
+session.MemorySessionStorage. Every case is run in a new process and measured
+by the growth of its resident memory, so it only works on Linux.
+
+Usage:
+    python bench/session_memory.py [count]
+"""
+
+import datetime
+import os
+import random
+import string
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tornado.util
+
+import session
+
+
+class LegacySession(object):
+    """The session before it was compacted."""
+    def __init__(self, key, expire_time, value=None):
+        self.key = key
+        self.expire_time = expire_time
+        self.value = tornado.util.ObjectDict(value or dict())
+
+
+def legacy(count):
+    """Create count sessions the old way. Return the storage."""
+    storage = dict()
+    for i in xrange(count):
+        create_time = datetime.datetime.utcnow()
+        key = ''.join([str(create_time)] +
+                      random.sample(string.ascii_letters, 10))
+        storage[key] = LegacySession(key,
+                                     create_time + datetime.timedelta(hours=1),
+                                     dict(ip='203.0.113.7', user=i))
+    return storage
+
+
+def compact(count):
+    """Create count sessions by a SessionManager. Return the storage."""
+    manager = session.SessionManager()
+    for i in xrange(count):
+        manager.create_session(dict(ip='203.0.113.7', user=i))
+        if len(manager.dirty) >= 1000:
+            manager.flush()
+    manager.flush()
+    return manager.storage
+
+
+def resident_bytes():
+    """Return the resident memory of this process in bytes."""
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def measure(case, count):
+    """Run the case in this process and print the bytes per session."""
+    before = resident_bytes()
+    storage = globals()[case](count)
+    after = resident_bytes()
+    print (after - before) / float(count)
+    if isinstance(storage, session.MemorySessionStorage):
+        print storage.stats()['bytes'] / float(count)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    print 'sessions: {0}'.format(count)
+    for case in ('legacy', 'compact'):
+        output = subprocess.check_output([sys.executable, __file__,
+                                          '--measure', case, str(count)])
+        lines = output.split()
+        print '{0:>8}: {1:7.1f} bytes/session (resident)'.format(
+            case, float(lines[0]))
+        if len(lines) > 1:
+            print '{0:>8}  {1:7.1f} bytes/session (stats estimate)'.format(
+                '', float(lines[1]))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == '--measure':
+        measure(sys.argv[2], int(sys.argv[3]))
+    else:
+        main()
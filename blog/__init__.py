@@ -1,14 +1,12 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-"""Beryllium is a simple blog application based on Tornado."""
+"""Beryllium is a simple blog application based on Tornado.
 
-import application
-import urls
-import handlers
-import context
-import options
-import model
+Importing the package or its modules has no side effect: nothing is
+connected, parsed or created. Call bootstrap to load the config, then the
+engine and the context are created when they are first used.
+"""
 
 __all__ = ['application',
            'urls',
@@ -16,4 +14,55 @@ __all__ = ['application',
            'context',
            'options',
            'model',
+           'cache',
+           'bus',
+           'passwords',
+           'metrics',
+           'slow_queries',
+           'profiling',
+           'memory',
+           'bootstrap',
            ]
+
+
+def bootstrap(config_path=None, db_url=None):
+    """Load the config and prepare the blog by it. Calling it again does
+    nothing.
+
+    The engine is created by db_url if it is given, otherwise it is created
+    by the database options when the database is first used, so a process
+    forking the workers never opens a connection.
+    args:
+        config_path(str, default=None):
+            The config file. Use blog/config.py if it is None.
+        db_url(str, default=None):
+            The database URL instead of the database options.
+    """
+    import memory
+    import metrics
+    import model
+    import options as options_module
+    import profiling
+    import slow_queries
+    from options import options
+
+    if options_module.loaded_path is None:
+        options_module.load_config(config_path)
+        model.user_cache.configure(max_entries=options.user_cache_size,
+                                   ttl=options.user_cache_ttl)
+        #The index may be loaded from a replica lagging behind.
+        model.Article.index.configure(
+            ttl=options.article_index_ttl,
+            lag=options.db_replica_lag if options.db_replica_urls else 0)
+        #Before the engine is created, so its queries are counted.
+        if options.metrics:
+            metrics.enable()
+        slow_queries.log.configure(threshold=options.slow_query_ms / 1000.0,
+                                   max_entries=options.slow_query_log_size)
+        profiling.profiler.configure(directory=options.profile_dir,
+                                     max_dumps=options.profile_max_dumps)
+        memory.telemetry.configure(top=options.memory_snapshot_top)
+        if options.memory_tracemalloc:
+            memory.start_tracing()
+    if db_url is not None:
+        model.init_engine(db_url)
@@ -5,7 +5,11 @@
 from tornado import web
 
 import urls  # This module defines the urls.
+import handlers
 import context as ctx_module
+import memory
+import metrics
+import model
 
 from options import options
 
@@ -17,15 +21,22 @@ class Application(web.Application):
         This application will prepare something for the blog app:
             It will create an alias of urls.urls and use it to initialize.
             Update the context by the context module's context.
+            Subscribe the changes on the context's bus.
+            Export the sizes of the context's storages as metrics, and
+            report them in the memory snapshots.
         args:
             context(tornado.util.ObjectDict): containing something the application
-                need, created by the server.py.
+                need (such as the bus), created by the server.py.
         """
         #Make an alias of the urls.
         self.app_urls = urls.urls
 
-        context.update(ctx_module.context)
+        context.update(ctx_module.init_context())
         self.ctx = context
+        #Update the caches when the other workers change the data.
+        handlers.subscribe(self.ctx)
+        metrics.watch_context(self.ctx, model.user_cache)
+        memory.watch_context(self.ctx)
 
         super(Application, self).__init__(debug=options.debug,
                                           cookie_secret=options.cookie_secret,
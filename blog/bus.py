@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module defines the bus carrying the invalidations between workers.
+
+Every worker keeps caches in its memory, such as the page cache and the user
+cache. When a worker changes the data, it drops its own cached copies and
+publishes the change on the bus, so the other workers drop theirs too.
+
+Every worker binds a UNIX datagram socket in the bus directory, and a message
+is sent to every socket there except the sender's. The messages are received
+on the IOLoop of the workers. A message can be lost if a worker's socket
+buffer is full, then its copies are stale until they expire.
+"""
+
+import errno
+import glob
+import json
+import os
+import socket
+import time
+
+from tornado import ioloop
+
+
+class InvalidationBus(object):
+    """A bus delivering messages to the other workers on the same host.
+
+    A message has a topic and some args which can be encoded in JSON. The
+    subscribers of the topic are called with the args on the IOLoop of the
+    receivers. The sender doesn't receive its own messages.
+
+    Usage:
+        bus = InvalidationBus('bus')
+        bus.subscribe('article', on_article)
+        bus.start()
+        bus.publish('article', title_for_url)
+    """
+    def __init__(self, directory):
+        """
+        args:
+            directory(str):
+                The directory of the sockets, shared by the workers.
+        """
+        self.directory = directory
+        self.path = os.path.join(directory, '{0}.sock'.format(os.getpid()))
+        self.subscribers = {}
+        self.socket = None
+        self.io_loop = None
+        #The counters of the messages, and the seconds between publishing
+        #and receiving them.
+        self.sent = 0
+        self.dropped = 0
+        self.received = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def subscribe(self, topic, callback):
+        """Call callback(*args) when a message of the topic is received."""
+        self.subscribers.setdefault(topic, []).append(callback)
+
+    def start(self, io_loop=None):
+        """Bind the socket of this worker and receive on the IOLoop.
+
+        args:
+            io_loop(tornado.ioloop.IOLoop, default=None):
+                Use IOLoop.current() if it is None.
+        """
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory, 0700)
+            except OSError as e:
+                #Created by another worker.
+                if e.errno != errno.EEXIST:
+                    raise
+        self.io_loop = io_loop or ioloop.IOLoop.current()
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.setblocking(0)
+        #Remove the socket left by a process with the same pid.
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.socket.bind(self.path)
+        self.io_loop.add_handler(self.socket.fileno(), self._on_readable,
+                                 ioloop.IOLoop.READ)
+
+    def publish(self, topic, *args):
+        """Send the message to the other workers. It is thread safe.
+
+        args:
+            topic(str);
+            args:
+                The args of the subscribers, can be encoded in JSON.
+        """
+        if self.socket is None:
+            return
+        data = json.dumps([topic, args, time.time()])
+        for path in glob.glob(os.path.join(self.directory, '*.sock')):
+            if path == self.path:
+                continue
+            try:
+                self.socket.sendto(data, path)
+                self.sent += 1
+            except socket.error as e:
+                if e.args[0] in (errno.ECONNREFUSED, errno.ENOENT):
+                    #The worker has exited, remove its socket.
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+                elif e.args[0] in (errno.EAGAIN, errno.ENOBUFS):
+                    self.dropped += 1
+                else:
+                    raise
+
+    def stats(self):
+        """Return a dict of the counters and the latency in seconds."""
+        return dict(sent=self.sent,
+                    dropped=self.dropped,
+                    received=self.received,
+                    latency_mean=(self.latency_total / self.received
+                                  if self.received else 0.0),
+                    latency_max=self.latency_max,
+                    )
+
+    def close(self):
+        """Stop receiving and remove the socket of this worker."""
+        if self.socket is None:
+            return
+        self.io_loop.remove_handler(self.socket.fileno())
+        self.socket.close()
+        self.socket = None
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def _on_readable(self, fd, events):
+        """Receive the messages and call the subscribers."""
+        while self.socket is not None:
+            try:
+                data = self.socket.recv(65536)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            topic, args, sent_time = json.loads(data)
+            latency = max(time.time() - sent_time, 0.0)
+            self.received += 1
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+            for callback in self.subscribers.get(topic, ()):
+                try:
+                    callback(*args)
+                except Exception:
+                    self.io_loop.handle_callback_exception(callback)
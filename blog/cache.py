@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module defines the caches used by the blog app."""
+
+import collections
+import time
+
+from tornado import concurrent
+from tornado import gen
+
+
+class _Entry(object):
+    """A cached page. Store the body, when it expires and its tags."""
+    __slots__ = ('body', 'expire_time', 'tags')
+
+    def __init__(self, body, expire_time, tags):
+        self.body = body
+        self.expire_time = expire_time
+        self.tags = tags
+
+
+class PageCache(object):
+    """A LRU cache of rendered pages bounded by bytes and a TTL.
+
+    Every page is stored with some tags, such as 'articles' for the article
+    list pages. Use invalidate(tag) to drop every page having the tag when the
+    data it was rendered from is changed.
+
+    If the data may be read from somewhere lagging behind, such as a read
+    replica, the renders of a page whose tag has been invalidated recently
+    should read fresh data, see fresh_until.
+
+    It isn't thread safe. Use it on the IOLoop only.
+    """
+    def __init__(self, max_bytes, ttl, fresh_seconds=0):
+        """
+        args:
+            max_bytes(int):
+                How many bytes of pages the cache keeps at most. The least
+                recently used pages will be dropped when it is exceeded. Use 0
+                to store nothing.
+            ttl(int or float):
+                How many seconds a page can be served after it is stored.
+            fresh_seconds(int or float, default=0):
+                How many seconds the renders of the pages having a tag should
+                read fresh data after the tag is invalidated.
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.fresh_seconds = fresh_seconds
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.tags = {}
+        #Every invalidation takes the next sequence number, and the
+        #generation of a tag is the number of its last invalidation. A render
+        #isn't stored if one of its tags, including the ones it adds, has
+        #been invalidated since it started. Only the generations newer than
+        #the start of the oldest render in progress are kept.
+        self.sequence = 0
+        self.generations = {}
+        #The sequence number at the start to the number of the renders in
+        #progress.
+        self.rendering = collections.Counter()
+        self.epoch = 0
+        #The tag to the time before which its renders should read fresh data.
+        self.fresh = {}
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Return the body of the cached page with key, or None."""
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return None
+        if entry.expire_time < time.time():
+            self._forget(key, entry)
+            return None
+        #Move it to the end, it is the most recently used now.
+        self.entries[key] = entry
+        return entry.body
+
+    def set(self, key, body, tags=()):
+        """Store the page and drop the least recently used ones if necessary.
+
+        args:
+            key(hashable):
+                The key of the page, such as the route and its args.
+            body(str):
+                The rendered page.
+            tags(sequence of str):
+                The tags of the page.
+        """
+        self.delete(key)
+        if len(body) > self.max_bytes:
+            return
+        entry = _Entry(body, time.time() + self.ttl, tuple(tags))
+        self.entries[key] = entry
+        self.size += len(body)
+        for tag in entry.tags:
+            self.tags.setdefault(tag, set()).add(key)
+        while self.size > self.max_bytes:
+            old_key, old_entry = self.entries.popitem(last=False)
+            self._forget(old_key, old_entry)
+            self.evictions += 1
+
+    def delete(self, key):
+        """Drop the page with key if it is cached."""
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self._forget(key, entry)
+
+    def invalidate(self, tag):
+        """Drop every page having the tag.
+
+        The renders in progress for these pages won't be stored either.
+        """
+        if self.fresh_seconds > 0:
+            now = time.time()
+            for old_tag, until in self.fresh.items():
+                if until <= now:
+                    del self.fresh[old_tag]
+            self.fresh[tag] = now + self.fresh_seconds
+        self.sequence += 1
+        #The renders started later won't need it.
+        if self.rendering:
+            self.generations[tag] = self.sequence
+        for key in self.tags.pop(tag, ()):
+            self.delete(key)
+        for key, (future, tags) in self.pending.items():
+            if tag in tags:
+                del self.pending[key]
+
+    def clear(self):
+        """Drop every page. The renders in progress won't be stored."""
+        self.epoch += 1
+        self.entries.clear()
+        self.tags.clear()
+        self.generations.clear()
+        self.pending.clear()
+        self.size = 0
+
+    def fresh_until(self, tags):
+        """Return the time before which the renders of a page having the tags
+        should read fresh data, 0 if they needn't.
+        """
+        return max([self.fresh.get(tag, 0) for tag in tags] + [0])
+
+    def stats(self):
+        """Return a dict of the size and the counters of the cache."""
+        return dict(entries=len(self.entries),
+                    bytes=self.size,
+                    hits=self.hits,
+                    misses=self.misses,
+                    coalesced=self.coalesced,
+                    evictions=self.evictions,
+                    )
+
+    @gen.coroutine
+    def get_or_render(self, key, render, tags=(), fresh_until=0):
+        """Return the cached page, or render and store it.
+
+        If the page with key is being rendered, wait for that render instead
+        of rendering it again.
+        args:
+            key(hashable):
+                The key of the page.
+            render(callable):
+                Return a Future of the page's body. If the body is None, such
+                as the page is not found, it won't be stored.
+            tags(list of str):
+                The tags of the page. The render can add the tags known after
+                loading the data to it, such as the users the page shows.
+            fresh_until(int or float, default=0):
+                The render reads fresh data before this time, see
+                fresh_until. The page isn't stored if a tag added by the
+                render should be read fresh for longer.
+        return(tornado.concurrent.Future):
+            The future of the body.
+        """
+        body = self.get(key)
+        if body is not None:
+            self.hits += 1
+            raise gen.Return(body)
+        if key in self.pending:
+            self.coalesced += 1
+            body = yield self.pending[key][0]
+            raise gen.Return(body)
+
+        self.misses += 1
+        future = concurrent.Future()
+        self.pending[key] = (future, tags)
+        epoch, start = self.epoch, self.sequence
+        self.rendering[start] += 1
+        try:
+            try:
+                body = yield render()
+            except Exception as e:
+                future.set_exception(e)
+                raise
+            else:
+                future.set_result(body)
+            finally:
+                if self.pending.get(key, (None, None))[0] is future:
+                    del self.pending[key]
+
+            if (body is not None and
+                    not self._invalidated(epoch, start, tags) and
+                    self.fresh_until(tags) <= fresh_until):
+                self.set(key, body, tags)
+        finally:
+            self._end_render(start)
+        raise gen.Return(body)
+
+    def _end_render(self, start):
+        """Forget a render started at the sequence number start, and the
+        generations no render in progress needs any more.
+        """
+        self.rendering[start] -= 1
+        if not self.rendering[start]:
+            del self.rendering[start]
+        if not self.rendering:
+            self.generations.clear()
+            return
+        oldest = min(self.rendering)
+        for tag, generation in self.generations.items():
+            if generation <= oldest:
+                del self.generations[tag]
+
+    def _invalidated(self, epoch, sequence, tags):
+        """Return if the cache is cleared or one of the tags is invalidated
+        since the epoch and the sequence.
+        """
+        return epoch != self.epoch or any(
+            self.generations.get(tag, 0) > sequence for tag in tags)
+
+    def _forget(self, key, entry):
+        """Forget the size and tags of a removed entry."""
+        self.size -= len(entry.body)
+        for tag in entry.tags:
+            keys = self.tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tags[tag]
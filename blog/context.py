@@ -1,23 +1,153 @@
 #!/usr/bin/env python
 #! -*- coding: utf-8 -*-
-"""This module defines some useful object for the blog app."""
+"""This module defines some useful object for the blog app.
 
-import tempfile
+They are created by init_context, not by importing the module.
+"""
 
+import hashlib
+import logging
+import os
+import shutil
+
+import mako
 from mako import lookup
 from tornado import util
 
+import cache
 import options
+import passwords
+
+
+#The directory of the template files.
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'templates')
+
+
+def template_names(directory=TEMPLATE_DIR):
+    """Return the sorted names of the templates in the directory, like
+    'article.tpl', or 'admin/index.tpl' in the subdirectories.
+    """
+    names = []
+    for root, dirs, files in os.walk(directory):
+        for file_name in files:
+            path = os.path.relpath(os.path.join(root, file_name), directory)
+            names.append(path.replace(os.sep, '/'))
+    names.sort()
+    return names
+
+
+def templates_hash(directory=TEMPLATE_DIR):
+    """Return the hash of the names and contents of the templates, and the
+    version of mako which compiles them.
+    """
+    digest = hashlib.sha1(mako.__version__)
+    for name in template_names(directory):
+        with open(os.path.join(directory, name), 'rb') as f:
+            content = f.read()
+        digest.update('{0}\0{1}\0'.format(name, len(content)))
+        digest.update(content)
+    return digest.hexdigest()[:16]
+
+
+def template_module_directory(base, directory=TEMPLATE_DIR):
+    """Return the directory of the modules compiled from the templates.
+
+    It is the subdirectory of base named by the hash of the templates, so
+    the modules compiled from other versions of them are never loaded.
+    """
+    return os.path.join(os.path.abspath(base), templates_hash(directory))
+
 
+def prune_template_modules(template_lookup):
+    """Remove the modules compiled from the other versions of the templates.
 
+    Only call it when no process uses the old versions.
+    args:
+        template_lookup(mako.lookup.TemplateLookup).
+    return(list):
+        The directories removed.
+    """
+    current = template_lookup.module_directory
+    base = os.path.dirname(current)
+    removed = []
+    if not os.path.isdir(base):
+        return removed
+    for name in os.listdir(base):
+        path = os.path.join(base, name)
+        if path != current and os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+            removed.append(path)
+    return removed
+
+
+def warm_up_templates(template_lookup, directory=TEMPLATE_DIR):
+    """Compile and load all the templates, so the first requests don't.
+
+    The modules compiled by another worker or before the restart are loaded
+    from the module directory instead of compiling again. A broken template
+    is logged and skipped, so it only breaks its own pages, as without the
+    warm up.
+    args:
+        template_lookup(mako.lookup.TemplateLookup);
+        directory(str, default=TEMPLATE_DIR).
+    return(int):
+        How many templates are loaded.
+    """
+    loaded = 0
+    for name in template_names(directory):
+        try:
+            template_lookup.get_template(name)
+        except Exception:
+            logging.exception('Failed to compile the template %s.', name)
+        else:
+            loaded += 1
+    return loaded
+
+
+#The objects shared by the requests. It is empty until init_context is called.
 context = util.ObjectDict()
 
-#Prepare the TemplateLookup
-context.template_lookup = lookup.TemplateLookup(
-    directories=['blog/templates'],  # Path to look up templates.
-    module_directory=tempfile.mkdtemp(),    # Create a temp directory to store
-                                            # compiled templates.
-    filesystem_checks=options.options.debug,  # Track the template file, when
-                                              # it is modified, reload it.
-    input_encoding='utf-8',  # Encoding of the template files.
-)
+
+def init_context():
+    """Fill the context by the options if it is empty, and return it.
+
+    Load the config before calling it, see blog.bootstrap.
+    """
+    if context:
+        return context
+
+    #Prepare the TemplateLookup
+    context.template_lookup = lookup.TemplateLookup(
+        directories=[TEMPLATE_DIR],  # Path to look up templates.
+        #The compiled templates are kept between the restarts and shared by
+        #the workers. Mako writes every module to a temp file then moves it,
+        #so the workers compiling the same template won't load a partial one.
+        module_directory=template_module_directory(
+            options.options.template_module_dir),
+        #Track the template file, when it is modified, reload it.
+        filesystem_checks=options.options.debug,
+        input_encoding='utf-8',  # Encoding of the template files.
+    )
+
+    #Prepare the cache of the pages rendered for the visitors who haven't
+    #logged in. The replicas may lag behind a change, so the pages changed
+    #are rendered from the primary meanwhile.
+    fresh_seconds = 0
+    if options.options.db_replica_urls:
+        fresh_seconds = options.options.db_replica_lag
+    context.page_cache = cache.PageCache(
+        max_bytes=options.options.page_cache_bytes,
+        ttl=options.options.page_cache_ttl,
+        fresh_seconds=fresh_seconds,
+    )
+
+    #Prepare the hasher of the passwords. Its executor is created on the first
+    #use, in the worker.
+    context.password_hasher = passwords.PasswordHasher(
+        algorithm=options.options.password_algorithm,
+        iterations=options.options.password_iterations,
+        workers=options.options.password_hash_workers,
+        use_processes=options.options.password_hash_processes,
+    )
+    return context
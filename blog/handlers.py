@@ -1,73 +1,339 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-"""The handlers module defines the Handlers used by the blog app."""
+"""The handlers module defines the Handlers used by the blog app.
+
+The handlers never touch the database on the IOLoop. Every model access is
+wrapped in a function run by self.run_on_db, and the handler methods are
+coroutines yielding its future. The functions run for one request share a
+session, which is closed when the request finishes.
+"""
 import datetime
+import functools
+import hmac
+import logging
+import os
+import time
 
+from tornado import gen
 from tornado import web
 
 from options import options
+import memory
+import metrics
 import model
+import profiling
+import slow_queries
 import utils
 
 
+def admin_required(method):
+    """Decorate the methods of the handlers only the admins can use.
+
+    Like web.authenticated, but respond 403 if the visitor has no admin
+    access, see BaseHandler.has_admin_access.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if not self.has_admin_access():
+            raise web.HTTPError(403)
+        return method(self, *args, **kwargs)
+    return wrapper
+
+
 class BaseHandler(web.RequestHandler):
     """The superclass of all Handler which will provide some common methods.
 
     This class shouldn't be used in the request handle behavior.
-    """
 
+    The sessions are kept by the server, or by the visitor in the signed
+    session cookie if the session_mode option is 'cookie'. A session too
+    large for the cookie is kept by the server instead.
+    """
+    #The session of the visitor, None if the visitor has none.
+    session = None
+    #If the session is kept in the session cookie.
+    session_in_cookie = False
+    #If the session cookie should be written.
+    session_dirty = False
+    #The current user, detached from the database session. Read it only.
+    user = None
+    #The queries of this request, if the metrics are enabled.
+    query_stats = None
+    #The profile of this request, if it is profiled.
+    profile = None
+    #The tags of the page rendered by cached_page.
+    page_tags = None
+    #When the database session of this request committed a write to the
+    #primary, set by model.BlogSession.
+    wrote_at = None
+    #The reads of this request go to the primary before this time, because
+    #the visitor has written recently.
+    read_primary_until = 0
+
+    @gen.coroutine
     def prepare(self):
         """Prepare for the handle process.
 
         Will create an alias for self.application.ctx.
-        Will check the vistor's secure cookie to get or create a session.
-        Will use visitor's IP address to protect the secure cookie from
-        being copy.
+        Will load the visitor's session (see load_session), and the current
+        user by the user_id stored in it. The user is got from the user cache,
+        so the database is used only when the user isn't cached.
+        If the visitor wrote less than db_replica_lag seconds ago, the reads
+        go to the primary, because the replicas may not have the change yet.
         """
+        self.start_profile()
+        #The database session of this request is created on the first use.
+        self.db_scope_opened = False
+        if metrics.enabled:
+            self.query_stats = metrics.QueryStats()
+
         self.reverse_url = utils.create_reverse_url(self.application,
                                                     options.host_pattern)
 
         #Create an alias for self.application.ctx
         self.ctx = self.application.ctx
 
-        session_id = self.get_secure_cookie('session_id')
-        if session_id in self.ctx.session_manager.storage:
-            session = self.ctx.session_manager.storage[session_id]
-            if session.value.ip != self.request.remote_ip:
-                self.create_session_for_visitor()
-            else:
-                #Refresh (extend the life time of) the session.
-                self.ctx.session_manager.refresh_session(session_id)
+        self.load_session()
+        if self.session is not None:
+            wrote_at = self.session.value.get('wrote_at')
+            if wrote_at is not None:
+                self.read_primary_until = wrote_at + options.db_replica_lag
+            user_id = self.session.value.get('user_id')
+            if user_id is not None:
+                user = model.user_cache.get(user_id)
+                if user is None:
+                    user = yield self.run_on_db(model.User.get_cached, user_id)
+                self.user = user
+
+    def start_profile(self):
+        """Profile this request if it carries a valid profile token, in the
+        X-Profile header or the _profile argument, or if it is sampled.
+
+        The tokens are given by ProfileHandler.
+        """
+        token = self.request.headers.get('X-Profile')
+        if token is None and '_profile' in self.request.arguments:
+            token = self.get_argument('_profile')
+        if token is not None:
+            token = web.decode_signed_value(
+                self.application.settings['cookie_secret'], 'profile', token,
+                max_age_days=1)
+        handler_name = type(self).__name__
+        if token is not None or profiling.profiler.sampled(handler_name):
+            self.profile = profiling.profiler.start(
+                handler_name,
+                '{0} {1}'.format(self.request.method, self.request.path))
+
+    def load_session(self):
+        """Get the session by the vistor's cookie.
+
+        If there is no valid session, self.session is None until something is
+        stored in it (see ensure_session), so anonymous requests don't create
+        sessions.
+        Will use visitor's IP address to protect the secure cookie from
+        being copy.
+        """
+        if options.session_mode == 'cookie':
+            session = self.get_cookie_session()
+            if (session is not None and
+                    session.value.get('ip') == self.request.remote_ip):
+                #Extend the life time when half of it has passed, so the
+                #cookie isn't written on every request.
+                manager = self.ctx.session_manager
+                remain = session.expire_time - time.time()
+                if remain < manager.default_expire.total_seconds() / 2:
+                    manager.touch(session)
+                    self.session_dirty = True
 
                 self.session = session
-        else:
-            self.create_session_for_visitor()
+                self.session_in_cookie = True
+                return
+
+        session_id = self.get_secure_cookie('session_id')
+        session = self.ctx.session_manager.get_session(session_id)
+        if (session is not None and
+                session.value['ip'] == self.request.remote_ip):
+            #Refresh (extend the life time of) the session.
+            self.ctx.session_manager.refresh(session)
+
+            self.session = session
+
+    def finish(self, chunk=None):
+        """Override to write the session cookie before the headers are sent.
+
+        If this request has written to the primary, store the time in the
+        visitor's session, see prepare.
+        """
+        if self.wrote_at is not None:
+            self.ensure_session().value['wrote_at'] = self.wrote_at
+            self.session_dirty = True
+        if self.session_in_cookie and self.session_dirty:
+            self.write_cookie_session()
+        super(BaseHandler, self).finish(chunk)
 
     def on_finish(self):
         """Clean up process.
 
-        Store the session.
+        Save the session if the server keeps it. It is written with the others
+        saved at the same time.
+        Close the database session of this request.
+        Record the metrics of this request, and dump its profile.
         """
-        key = self.session.key
-        self.ctx.session_manager.storage[key] = self.session
+        if self.session is not None and not self.session_in_cookie:
+            self.ctx.session_manager.save_session(self.session)
+
+        if self.db_scope_opened:
+            model.close_scope(self)
+
+        if metrics.enabled:
+            metrics.record_request(type(self).__name__, self.request.method,
+                                   self.get_status(),
+                                   self.request.request_time(),
+                                   self.query_stats)
+
+        if self.profile is not None:
+            name = profiling.profiler.finish(self.profile)
+            self.profile = None
+            logging.info('The profile of %s %s is dumped to %s.',
+                         self.request.method, self.request.uri, name)
 
     def create_session_for_visitor(self):
         """Create a new session and set the session_id secure cookie.
 
+        In the 'cookie' session mode, the session will be written to the
+        session cookie when the response finishes instead.
         Will store the IP address for protecting session_id secure cookie
         from being copy.
         """
+        if options.session_mode == 'cookie':
+            self.session = self.ctx.session_manager.new_session()
+            self.session.value['ip'] = self.request.remote_ip
+            self.session_in_cookie = True
+            self.session_dirty = True
+            return
         self.session = self.ctx.session_manager.create_session()
         key = self.session.key
-        self.session.value.ip = self.request.remote_ip
+        self.session.value['ip'] = self.request.remote_ip
         self.set_secure_cookie('session_id', key)
 
+    def get_cookie_session(self):
+        """Return the session in the session cookie, or None.
+
+        The session cookie is signed, so the visitor can't modify it.
+        """
+        data = self.get_secure_cookie('session')
+        if data is None:
+            return None
+        return self.ctx.session_manager.decode_session(data)
+
+    def write_cookie_session(self):
+        """Write the session to the session cookie.
+
+        If the session can't be encoded, or it is larger than the
+        session_cookie_max_bytes option, keep it on the server instead.
+        """
+        manager = self.ctx.session_manager
+        data = manager.encode_session(self.session)
+        if data is not None:
+            value = self.create_signed_value('session', data)
+            if len(value) <= options.session_cookie_max_bytes:
+                self.set_cookie('session', value, expires_days=30)
+                self.session_dirty = False
+                return
+
+        #Fall back to the server side storage.
+        self.clear_cookie('session')
+        self.session.key = manager.new_key()
+        manager.save_session(self.session)
+        self.set_secure_cookie('session_id', self.session.key)
+        self.session_in_cookie = False
+        self.session_dirty = False
+
+    def ensure_session(self):
+        """Create a session for the visitor if there isn't one.
+
+        Call it before storing something in self.session, and before the
+        response is flushed, because it may set a cookie.
+        return(session.Session):
+            The session of the visitor.
+        """
+        if self.session is None:
+            self.create_session_for_visitor()
+        return self.session
+
+    def drop_session(self):
+        """Delete the visitor's session and clear its cookie."""
+        if self.session is None:
+            return
+        if self.session_in_cookie:
+            self.clear_cookie('session')
+            self.session_in_cookie = False
+            self.session_dirty = False
+        else:
+            try:
+                self.ctx.session_manager.del_session(self.session.key)
+            except KeyError:
+                #It has been cleaned as expired.
+                pass
+            self.clear_cookie('session_id')
+        self.session = None
+
+    def run_on_db(self, func, *args, **kwargs):
+        """Run func(*args, **kwargs) on the database executor.
+
+        Yield the result in a coroutine:
+            article = yield self.run_on_db(model.Article.get_article, name)
+        All the functions run for this request share a database session. The
+        objects returned by func will be used on the IOLoop, so func should
+        load everything the template needs.
+        return(concurrent.futures.Future):
+            The future of func's result.
+        """
+        self.db_scope_opened = True
+        if self.profile is not None:
+            func = self.profile.wrap(func)
+        return model.run_in_scope(self, func, *args, **kwargs)
+
+    def cached_page(self, key, tags, render, *args):
+        """Return the future of the page rendered by render(*args).
+
+        The pages for the visitors who haven't logged in are the same for
+        everyone, so they are got from the page cache, and the concurrent
+        misses of the same page wait for one render. Invalidate the tags when
+        the data of the page is changed. The render reads from the primary
+        database while the replicas may not have the change of a tag yet.
+        args:
+            key(tuple):
+                The route and the args of the page.
+            tags(sequence of str):
+                The tags of the page. render can add the tags known after
+                loading, such as the users shown, to self.page_tags.
+            render(callable):
+                Return a Future of the page's body, or of None if the page
+                shouldn't be cached (such as not found).
+        return(tornado.concurrent.Future).
+        """
+        self.page_tags = list(tags)
+        if self.get_current_user() is not None:
+            return render(*args)
+        page_cache = self.ctx.page_cache
+        fresh_until = page_cache.fresh_until(self.page_tags)
+        self.read_primary_until = max(self.read_primary_until, fresh_until)
+        return page_cache.get_or_render(
+            key, functools.partial(render, *args), self.page_tags,
+            fresh_until)
+
     def render_string(self, template_name, **kwargs):
         """Override it to provide mako templates support."""
         template = self.ctx.template_lookup.get_template(template_name)
         namespace = self.get_template_namespace()
         namespace.update(kwargs)
-        return template.render(**namespace)
+        if not metrics.enabled:
+            return template.render(**namespace)
+        start = time.time()
+        result = template.render(**namespace)
+        metrics.render_seconds.observe(time.time() - start, (template_name,))
+        return result
 
     def get_template_namespace(self):
         """Override to provide some common variables to template."""
@@ -76,25 +342,41 @@ class BaseHandler(web.RequestHandler):
                     reverse_url=self.reverse_url,
                     )
 
+    def has_admin_access(self):
+        """Return if the visitor can use the admin pages.
+
+        The host and the admins of the blog can.
+        """
+        user = self.get_current_user()
+        return user is not None and user.status in ('host', 'admin')
+
     def get_current_user(self):
-        """Override to determine the current user."""
-        if 'user' in self.session.value:
-            return self.session.value.user
-        else:
-            return None
+        """Override to determine the current user.
+
+        The user is loaded by prepare, see it.
+        """
+        return self.user
 
     def set_current_user(self, user):
-        """Set the current user.
+        """Set the current user. Create a session if the visitor has none.
 
+        Only the user's id is stored in the session, so it is small enough
+        for the session cookie.
         args:
             user(model.User):
                 The current user you want to set.
         """
-        self.session.value.user = user
+        self.ensure_session().value['user_id'] = user.id
+        self.session_dirty = True
+        self.user = user
 
     def empty_current_user(self):
-        """Set current user empty (None)."""
-        self.set_current_user(None)
+        """Set current user empty (None).
+
+        Nothing else is stored in the session, so drop it.
+        """
+        self.drop_session()
+        self.user = None
 
 
 class HomeHandler(BaseHandler):
@@ -111,6 +393,7 @@ class RegisterHandler(BaseHandler):
         """Render the register template."""
         self.render('register.tpl')
 
+    @gen.coroutine
     def post(self):
         """Check the request's email and nickname and create a User.
 
@@ -125,14 +408,24 @@ class RegisterHandler(BaseHandler):
         except (web.MissingArgumentError, ValueError):
             self.render('register.failed.tpl')
             return
-        if (not model.User.have_user(email) and
-                not model.User.have_user(nickname, is_nickname=True)):
-            user = model.User(email,
-                              password,
-                              nickname,
-                              self.request.remote_ip)
-            user.track()
-            model.commit()
+        ip = self.request.remote_ip
+        #Hash it on the hasher's executor, it is slow.
+        password_hash = yield self.ctx.password_hasher.hash(password)
+
+        def register():
+            """Create the user if the email and nickname are unique."""
+            if (not model.User.have_user(email) and
+                    not model.User.have_user(nickname, is_nickname=True)):
+                user = model.User(email, None, nickname, ip,
+                                  password_hash=password_hash)
+                user.track()
+                model.commit()
+                return user
+            else:
+                return None
+
+        user = yield self.run_on_db(register)
+        if user is not None:
             self.set_current_user(user)
             self.render('register.successful.tpl')
         else:
@@ -146,6 +439,7 @@ class LoginHandler(BaseHandler):
         """When receive a get request of login, render the login template."""
         self.render('login.tpl')
 
+    @gen.coroutine
     def post(self):
         """When receive a post request of login check it and display result.
 
@@ -158,18 +452,35 @@ class LoginHandler(BaseHandler):
         except web.MissingArgumentError:
             self.render('login.failed.tpl')
             return
-        user = model.User.get_user_by_email_and_password(email, password)
-        if user is None:
+        ip = self.request.remote_ip
+
+        user = yield self.run_on_db(model.User.get_user_by_email, email)
+        matched = False
+        if user is not None:
+            #Verify it on the hasher's executor, it is slow. Rehash it if it
+            #was hashed by an old algorithm or cost.
+            matched, new_hash = yield self.ctx.password_hasher.verify(
+                password, user.password, user.legacy_salts)
+
+        def login():
+            """Update user's information."""
+            user.last_login_time = datetime.datetime.utcnow()
+            user.last_login_ip = ip
+            if new_hash is not None:
+                user.password = new_hash
+            model.commit()
+
+        if not matched:
             self.render('login.failed.tpl')
         else:
+            yield self.run_on_db(login)
+            #The user is dropped from the user cache of this worker when
+            #updated, drop its pages and tell the others.
+            _user_changed(self.ctx, user.id)
+            self.ctx.bus.publish('user', user.id)
             self.set_current_user(user)
             self.render('login.successful.tpl')
 
-            #Update user's information.
-            user.last_login_time = datetime.datetime.utcnow()
-            user.last_login_ip = self.request.remote_ip
-            model.commit()
-
 
 class LogoutHandler(BaseHandler):
     """Access logout request."""
@@ -182,6 +493,7 @@ class LogoutHandler(BaseHandler):
 class UserInfoHandler(BaseHandler):
     """Handler of displaying user's information."""
     @web.addslash
+    @gen.coroutine
     def get(self, user_id=None):
         """Render the user_info template.
 
@@ -191,14 +503,14 @@ class UserInfoHandler(BaseHandler):
         user_info template for displaying current user's information, if
         get_current_user is None, write 404 error.
         """
+        if user_id is None and self.get_current_user() is not None:
+            user_id = self.get_current_user().id
         if user_id is not None:
-            user = model.User.get_user(int(user_id))
+            user = yield self.run_on_db(_load_user, int(user_id))
             if user is not None:
                 self.render('user_info.tpl', user=user)
             else:
                 self.write_error(404)
-        elif self.get_current_user() is not None:
-            self.render('user_info.tpl', user=self.get_current_user())
         else:
             self.write_error(404)
 
@@ -211,6 +523,7 @@ class ArticleSubmitHandler(BaseHandler):
         self.render('article_submit.tpl')
 
     @web.authenticated
+    @gen.coroutine
     def post(self):
         """Accept the post request.
 
@@ -233,13 +546,23 @@ class ArticleSubmitHandler(BaseHandler):
         #TODO rtnelo@yeah.net 2013.09.14 16:29
         #Rewrite the status condition if the status was modified.
         if author is not None and author.status != 'user':
-            article = model.Article(title=title,
-                                    title_for_url=title_for_url,
-                                    raw=raw,
-                                    author=author,
-                                    )
-            article.track()
-            model.commit()
+            def submit():
+                """Create the article and store it."""
+                article = model.Article(title=title,
+                                        title_for_url=title_for_url,
+                                        raw=raw,
+                                        author=_attach(author),
+                                        )
+                article.track()
+                model.commit()
+                return article
+
+            article = yield self.run_on_db(submit)
+            submit_time = article.submit_time.strftime(_TIME_FORMAT)
+            _article_submitted(self.ctx, title_for_url, submit_time,
+                               article.id)
+            self.ctx.bus.publish('article', title_for_url, submit_time,
+                                 article.id)
             self.render('article_submit.successful.tpl', article=article)
         else:
             self.render('article_submit.failed.tpl')
@@ -248,6 +571,7 @@ class ArticleSubmitHandler(BaseHandler):
 class CommentSubmitHandler(BaseHandler):
     """Accept comment submit request. Only accept post request."""
     @web.authenticated
+    @gen.coroutine
     def post(self):
         """Process the submit request of comment.
 
@@ -263,14 +587,22 @@ class CommentSubmitHandler(BaseHandler):
             return
         author = self.get_current_user()
         if author is not None:
-            article = model.Article.get_article(title_for_url)
+            def submit():
+                """Create the comment if the article exists."""
+                article = model.Article.get_article(title_for_url)
+                if article is not None:
+                    comment = model.Comment(raw=raw,
+                                            author=_attach(author),
+                                            article=article,
+                                            )
+                    comment.track()
+                    model.commit()
+                return article
+
+            article = yield self.run_on_db(submit)
             if article is not None:
-                comment = model.Comment(raw=raw,
-                                        author=author,
-                                        article=article,
-                                        )
-                comment.track()
-                model.commit()
+                _comment_submitted(self.ctx, title_for_url)
+                self.ctx.bus.publish('comment', title_for_url)
                 self.render('comment_submit.successful.tpl', article=article)
             else:
                 self.render('comment_submit.failed.tpl')
@@ -280,23 +612,285 @@ class CommentSubmitHandler(BaseHandler):
 
 class ArticleHandler(BaseHandler):
     @web.addslash
+    @gen.coroutine
     def get(self, title_for_url):
-        article = model.Article.get_article(title_for_url)
-        if article is not None:
-            self.render('article.tpl', article=article, comments=article.comments)
+        """Render the article with a page of its comments, oldest first.
+
+        The page of comments is given by the after argument, the id of the last
+        comment of the previous page. The template gets next_comment, the
+        after argument of the next page (None if this is the last page).
+        The page is cached for anonymous visitors.
+        """
+        after = self.get_argument('after', None)
+        if after is not None:
+            try:
+                after = int(after)
+            except ValueError:
+                raise web.HTTPError(404)
+        html = yield self.cached_page(('article', title_for_url, after),
+                                      [_article_tag(title_for_url)],
+                                      self.render_article,
+                                      title_for_url, after)
+        if html is not None:
+            self.finish(html)
         else:
             self.write_error(404)
 
+    @gen.coroutine
+    def render_article(self, title_for_url, after=None):
+        """Return the future of the rendered article, or None if not found."""
+        limit = options.comments_per_page
+        result = yield self.run_on_db(_load_article, title_for_url, after,
+                                      limit)
+        if result is not None:
+            article, comments = result
+            self.page_tags.extend(_user_tags([article] + comments))
+            if len(comments) > limit:
+                comments = comments[:limit]
+                next_comment = comments[-1].id
+            else:
+                next_comment = None
+            html = self.render_string('article.tpl', article=article,
+                                      comments=comments,
+                                      next_comment=next_comment)
+        else:
+            html = None
+        raise gen.Return(html)
+
 
 class ArticleListHandler(BaseHandler):
     @web.addslash
+    @gen.coroutine
     def get(self, page=1):
+        """Render a page of the articles, newest first.
+
+        The page can be given by its number or by the after argument, the
+        cursor of the last article of the previous page. Both of them seek the
+        page by its key, so a deep page costs the same as the first one. The
+        template gets next_cursor, the after argument of the next page (None
+        if this is the last page).
+        """
         #TODO: Use user's config in stead of the magic number.
-        count = model.Article.count()
-        ubound = int(count / 20) + 1
-        page = page if page <= ubound else ubound
-        offset = (page - 1) * 20
         limit = 20
-        articles = model.Article.part(offset, limit)
-        self.render('article_list.tpl', page=page, ubound=ubound,
-                    articles=articles)
+        page = int(page)
+        after = self.get_argument('after', None)
+        if after is not None:
+            try:
+                after = model.Article.parse_cursor(after)
+            except ValueError:
+                raise web.HTTPError(404)
+
+        html = yield self.cached_page(('articles', page, after), ['articles'],
+                                      self.render_list, page, after, limit)
+        self.finish(html)
+
+    @gen.coroutine
+    def render_list(self, page, after, limit):
+        """Return the future of the rendered page of the articles."""
+        def load():
+            """Count the articles and load the ones of the page."""
+            count = model.Article.count()
+            ubound = max(1, (count + limit - 1) // limit)
+            if after is not None:
+                articles = model.Article.page_after(after, limit)
+                current = model.Article.index.position_after(after)
+                current = current // limit + 1
+            else:
+                current = min(page, ubound)
+                articles = model.Article.page(current, limit)
+            return current, ubound, articles
+
+        page, ubound, articles = yield self.run_on_db(load)
+        self.page_tags.extend(_user_tags(articles))
+        if page < ubound and articles:
+            next_cursor = articles[-1].cursor
+        else:
+            next_cursor = None
+        raise gen.Return(self.render_string('article_list.tpl', page=page,
+                                            ubound=ubound, articles=articles,
+                                            next_cursor=next_cursor))
+
+
+class MetricsHandler(BaseHandler):
+    """Export the metrics of this worker in the text format of Prometheus.
+
+    A metrics collector can send the metrics_token option in the
+    "Authorization: Bearer" header instead of logging in.
+    """
+    def has_admin_access(self):
+        """The admins, and the metrics collector with the token, can."""
+        token = options.metrics_token
+        if token:
+            header = self.request.headers.get('Authorization', '')
+            if hmac.compare_digest(str(header), 'Bearer ' + token):
+                return True
+        return super(MetricsHandler, self).has_admin_access()
+
+    @admin_required
+    def get(self):
+        if not metrics.enabled:
+            raise web.HTTPError(404)
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.finish(metrics.registry.render().encode('utf-8'))
+
+
+class SlowQueryHandler(BaseHandler):
+    """Show the slow queries of this worker, the latest first, in JSON."""
+    @admin_required
+    def get(self):
+        self.write(dict(stats=slow_queries.log.stats(),
+                        queries=slow_queries.log.snapshot()))
+
+
+class ProfileHandler(BaseHandler):
+    """Show the profiles dumped, and set the sampling of the handlers.
+
+    GET returns in JSON the dumps, the sample rates of this worker and a
+    profile token valid for a day. A request sending the token in the
+    X-Profile header or the _profile argument is profiled:
+        curl -H 'X-Profile: <token>' http://host/article/hello/
+    POST sets the fraction of a handler's requests profiled by every worker,
+    with the handler (the class name) and rate (0 to 1) arguments.
+    """
+    @admin_required
+    def get(self):
+        self.write(dict(token=self.create_signed_value('profile', 'profile'),
+                        sample_rates=profiling.profiler.sample_rates,
+                        dumps=profiling.profiler.dumps()))
+
+    @admin_required
+    def post(self):
+        handler_name = self.get_argument('handler')
+        try:
+            rate = float(self.get_argument('rate'))
+        except ValueError:
+            raise web.HTTPError(400)
+        profiling.profiler.set_sample_rate(handler_name, rate)
+        self.ctx.bus.publish('profile_sampling', handler_name, rate)
+        self.write(dict(sample_rates=profiling.profiler.sample_rates))
+
+
+class ProfileDumpHandler(BaseHandler):
+    """Download a profile dumped, the .prof one is a pstats file."""
+    @admin_required
+    def get(self, name):
+        path = profiling.profiler.path_of(name)
+        if path is None:
+            raise web.HTTPError(404)
+        if name.endswith('.txt'):
+            self.set_header('Content-Type', 'text/plain')
+        else:
+            self.set_header('Content-Type', 'application/octet-stream')
+            self.set_header('Content-Disposition',
+                            'attachment; filename={0}'.format(name))
+        with open(path, 'rb') as f:
+            self.finish(f.read())
+
+
+class MemoryHandler(BaseHandler):
+    """Show the memory snapshots of this worker in JSON, the latest first.
+
+    The response tells the worker, which is the one the request lands on.
+    The worker 0 takes them periodically if the memory_snapshot_minutes
+    option is set (interval_minutes). With the snapshot argument, a new one
+    is taken first, which takes a while if the heap is large.
+    """
+    @admin_required
+    def get(self):
+        telemetry = memory.telemetry
+        if self.get_argument('snapshot', None):
+            telemetry.snapshot()
+        self.write(dict(worker=telemetry.worker,
+                        pid=os.getpid(),
+                        interval_minutes=telemetry.interval_minutes,
+                        snapshots=list(reversed(telemetry.snapshots))))
+
+
+def _article_tag(title_for_url):
+    """Return the page cache tag of the article's page."""
+    return u'article:{0}'.format(title_for_url)
+
+
+def _user_tag(id):
+    """Return the page cache tag of the pages showing the user."""
+    return u'user:{0}'.format(id)
+
+
+def _user_tags(entries):
+    """Return the page cache tags of the authors of the articles or the
+    comments.
+    """
+    return [_user_tag(id) for id in
+            set(entry.author_id for entry in entries
+                if entry.author_id is not None)]
+
+
+#The format of the submit time of articles in the messages on the bus.
+_TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+#Functions updating the caches when the data is changed. The handlers call
+#them after committing the change, and publish it on ctx.bus, so the other
+#workers call them too.
+def subscribe(ctx):
+    """Subscribe the changes published by the other workers on ctx.bus."""
+    ctx.bus.subscribe('article', functools.partial(_article_submitted, ctx))
+    ctx.bus.subscribe('comment', functools.partial(_comment_submitted, ctx))
+    ctx.bus.subscribe('user', functools.partial(_user_changed, ctx))
+    ctx.bus.subscribe('profile_sampling',
+                      profiling.profiler.set_sample_rate)
+
+
+def _article_submitted(ctx, title_for_url, submit_time, id):
+    """Add the new article to the index and drop the pages showing it."""
+    submit_time = datetime.datetime.strptime(submit_time, _TIME_FORMAT)
+    model.Article.index.add((submit_time, id))
+    ctx.page_cache.invalidate('articles')
+    ctx.page_cache.invalidate(_article_tag(title_for_url))
+
+
+def _comment_submitted(ctx, title_for_url):
+    """Drop the page of the article commented."""
+    ctx.page_cache.invalidate(_article_tag(title_for_url))
+
+
+def _user_changed(ctx, id):
+    """Drop the user from the user cache and the pages showing it."""
+    model.user_cache.invalidate(id)
+    ctx.page_cache.invalidate(_user_tag(id))
+
+
+#Functions run on the database executor.
+def _attach(user):
+    """Attach the user of the visitor's session to the executor's session.
+
+    The user was loaded by the session of an earlier request and is detached
+    now, merge a copy without querying the database.
+    """
+    return model.session.merge(user, load=False)
+
+
+def _load_user(id):
+    """Get the user by id and load the relationships displayed with it."""
+    user = model.User.get_user(id)
+    if user is not None:
+        user.articles
+        user.comments
+    return user
+
+
+def _load_article(title_for_url, after, limit):
+    """Get the article with its author, and a page of its comments with
+    their authors. Two queries however many comments there are.
+
+    The page has limit+1 comments at most, the last one tells if there is a
+    next page.
+    return(tuple or None):
+        (article, comments), or None if the article is not found.
+    """
+    article = model.Article.get_article(title_for_url, with_author=True,
+                                       with_content=True)
+    if article is None:
+        return None
+    comments = model.Comment.page_of_article(article.id, after, limit + 1)
+    return (article, comments)
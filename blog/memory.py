@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module takes snapshots of the memory of the process.
+
+A snapshot has the size of the process, the sizes of the structures which
+may grow (the session storage, the database sessions and their identity
+maps, the templates loaded, the caches), and the allocations growing most
+since the previous snapshot. The allocations are traced by tracemalloc if it
+is available and started (see the memory_tracemalloc option), otherwise the
+objects tracked by the garbage collector are counted by type, which costs
+nothing between the snapshots. Counting walks the objects on the IOLoop, so
+at most MAX_COUNTED_OBJECTS of them are counted, evenly spaced, and the
+counts are scaled up.
+
+The snapshots are taken on the IOLoop, which owns the session storage.
+"""
+
+import collections
+import gc
+import itertools
+import resource
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import model
+import slow_queries
+
+
+#How many objects a snapshot counts at most without tracemalloc.
+MAX_COUNTED_OBJECTS = 200000
+
+
+def rss_bytes():
+    """Return the resident set size of the process, or None if unknown."""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (IOError, IndexError, ValueError):
+        return None
+    return pages * resource.getpagesize()
+
+
+def max_rss_bytes():
+    """Return the peak resident set size of the process."""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #It is in bytes on Mac OS X, in kilobytes on Linux.
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def count_types(objects, max_objects=MAX_COUNTED_OBJECTS):
+    """Count the objects by type.
+
+    args:
+        objects(list):
+            The objects, such as gc.get_objects().
+        max_objects(int, default=MAX_COUNTED_OBJECTS):
+            How many objects are counted at most. If there are more, every
+            step-th one is counted and the result is multiplied by step.
+    return(tuple):
+        ({type name: [count, shallow bytes]}, step).
+    """
+    step = max(1, -(-len(objects) // max_objects))
+    counts = {}
+    for obj in itertools.islice(objects, 0, None, step):
+        name = type(obj).__name__
+        entry = counts.get(name)
+        if entry is None:
+            entry = counts[name] = [0, 0]
+        entry[0] += step
+        entry[1] += sys.getsizeof(obj, 0) * step
+    return (counts, step)
+
+
+def start_tracing(frames=1):
+    """Start tracemalloc if it is available.
+
+    return(bool):
+        If the allocations are traced.
+    """
+    if tracemalloc is None:
+        return False
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+    return True
+
+
+class MemoryTelemetry(object):
+    """Take and keep the snapshots of the memory.
+
+    Use it on the IOLoop only.
+    """
+    def __init__(self, top=20, max_snapshots=24):
+        """
+        args:
+            top(int, default=20):
+                How many allocation sites or types a snapshot lists.
+            max_snapshots(int, default=24):
+                How many snapshots are kept.
+        """
+        self.top = top
+        self.snapshots = collections.deque(maxlen=max_snapshots)
+        #The worker of this process, and how many minutes between the
+        #periodic snapshots it takes (0 if it doesn't).
+        self.worker = None
+        self.interval_minutes = 0
+        #The name to the function returning the sizes of a structure.
+        self.structures = collections.OrderedDict()
+        #The previous allocations to diff with.
+        self.previous_types = None
+        self.previous_trace = None
+
+    def configure(self, top):
+        self.top = top
+
+    def watch(self, name, read):
+        """Report the sizes of a structure in the snapshots.
+
+        args:
+            name(str);
+            read(callable):
+                Return a dict of the sizes, such as {'entries': 10}.
+        """
+        self.structures[name] = read
+
+    def snapshot(self):
+        """Take a snapshot and keep it.
+
+        return(dict):
+            time, rss_bytes, max_rss_bytes, gc_objects, structures (the name
+            to the sizes), and top_allocations (if tracemalloc is tracing,
+            the sites allocating most since the previous snapshot) or
+            top_types (the types whose objects grow most) with
+            sampled_every (1 if every object is counted).
+        """
+        start = time.time()
+        structures = collections.OrderedDict()
+        for name, read in self.structures.items():
+            try:
+                structures[name] = read()
+            except Exception as e:
+                structures[name] = dict(error=unicode(e))
+        objects = gc.get_objects()
+        snapshot = dict(time=start,
+                        rss_bytes=rss_bytes(),
+                        max_rss_bytes=max_rss_bytes(),
+                        gc_objects=len(objects),
+                        structures=structures,
+                        )
+        if tracemalloc is not None and tracemalloc.is_tracing():
+            snapshot['top_allocations'] = self._top_allocations()
+        else:
+            snapshot['top_types'], snapshot['sampled_every'] = (
+                self._top_types(objects))
+        del objects
+        snapshot['seconds'] = time.time() - start
+        self.snapshots.append(snapshot)
+        return snapshot
+
+    def _top_types(self, objects):
+        """Return the types growing most since the previous snapshot, and
+        the sampling step.
+        """
+        counts, step = count_types(objects)
+        previous = self.previous_types or {}
+        self.previous_types = counts
+        rows = []
+        for name, (count, size) in counts.items():
+            old_count, old_size = previous.get(name, (0, 0))
+            rows.append(dict(type=name, count=count, bytes=size,
+                             count_diff=count - old_count,
+                             bytes_diff=size - old_size))
+        rows.sort(key=lambda row: (row['bytes_diff'], row['bytes']),
+                  reverse=True)
+        return (rows[:self.top], step)
+
+    def _top_allocations(self):
+        """Return the sites allocating most since the previous snapshot."""
+        trace = tracemalloc.take_snapshot()
+        if self.previous_trace is None:
+            stats = trace.statistics('lineno')
+            rows = [dict(site=str(stat.traceback), bytes=stat.size,
+                         count=stat.count, bytes_diff=stat.size,
+                         count_diff=stat.count)
+                    for stat in stats[:self.top]]
+        else:
+            stats = trace.compare_to(self.previous_trace, 'lineno')
+            rows = [dict(site=str(stat.traceback), bytes=stat.size,
+                         count=stat.count, bytes_diff=stat.size_diff,
+                         count_diff=stat.count_diff)
+                    for stat in stats[:self.top]]
+        self.previous_trace = trace
+        return rows
+
+
+#The telemetry of this process. It is configured when the config is loaded,
+#see blog.bootstrap.
+telemetry = MemoryTelemetry()
+
+
+def watch_context(ctx):
+    """Report the structures of the application which may grow.
+
+    args:
+        ctx(tornado.util.ObjectDict):
+            The context with the session_manager, the template_lookup and
+            the page_cache.
+    """
+    manager = ctx.session_manager
+    lookup = ctx.template_lookup
+
+    def read_sessions():
+        sizes = dict(entries=len(manager.storage),
+                     unsaved=len(manager.dirty))
+        if hasattr(manager.storage, 'stats'):
+            sizes.update(manager.storage.stats())
+        return sizes
+
+    def read_templates():
+        #Mako keeps the templates loaded in these.
+        return dict(templates=len(lookup._collection),
+                    uris=len(lookup._uri_cache))
+
+    telemetry.watch('session_storage', read_sessions)
+    telemetry.watch('db_sessions', model.session_stats)
+    telemetry.watch('templates', read_templates)
+    telemetry.watch('page_cache', ctx.page_cache.stats)
+    telemetry.watch('user_cache', model.user_cache.stats)
+    telemetry.watch('article_index',
+                    lambda: dict(keys=len(model.Article.index.keys or ())))
+    telemetry.watch('slow_queries', slow_queries.log.stats)
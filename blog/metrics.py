@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module collects the performance metrics of the blog.
+
+The handlers record how long every request takes, how many queries it makes
+and how long they take, and how long the templates take to render. The
+gauges, such as the size of the session storage, are read when the metrics
+are exported. They are exported in the text format of Prometheus, see
+Registry.render.
+
+The metrics are recorded on the IOLoop, so they aren't thread safe. The
+queries run on the database executor are counted on the statistics of their
+scope (the request handler), which is read on the IOLoop after the queries
+have finished. Every worker keeps its own metrics.
+"""
+
+import bisect
+import time
+
+from sqlalchemy import event
+
+
+#The buckets of the histograms in seconds.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+#The buckets of the histograms counting the queries of a request.
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+def _format_value(value):
+    """Format a sample value or a bucket bound for Prometheus."""
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _format_labels(names, values):
+    """Return the labels like {a="1",b="2"}, or '' if there is none."""
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = unicode(value).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n')
+        pairs.append(u'{0}="{1}"'.format(name, value))
+    return u'{' + u','.join(pairs) + u'}'
+
+
+class Counter(object):
+    """A counter of every combination of the label values."""
+    type = 'counter'
+
+    def __init__(self, name, help, label_names=()):
+        """
+        args:
+            name(str):
+                The name of the metric, such as blog_responses_total.
+            help(str):
+                The description of the metric.
+            label_names(tuple of str, default=()).
+        """
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.values = {}
+
+    def inc(self, label_values=(), amount=1):
+        """Add amount to the counter of the label values."""
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        """Yield (name, label names, label values, value) of the samples."""
+        for label_values, value in sorted(self.values.items()):
+            yield (self.name, self.label_names, label_values, value)
+
+
+class Histogram(object):
+    """A histogram of every combination of the label values.
+
+    Like Prometheus, a bucket counts the observations less than or equal to
+    its bound, including the ones counted by the smaller buckets.
+    """
+    type = 'histogram'
+
+    def __init__(self, name, help, label_names=(), buckets=DEFAULT_BUCKETS):
+        """
+        args:
+            name(str):
+                The name of the metric, such as blog_request_seconds.
+            help(str):
+                The description of the metric.
+            label_names(tuple of str, default=());
+            buckets(sequence of number, default=DEFAULT_BUCKETS):
+                The upper bounds of the buckets, ascending. The +Inf bucket
+                is added.
+        """
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        #The label values to [bucket counts, sum, count]. The bucket counts
+        #aren't cumulative until exported.
+        self.values = {}
+
+    def observe(self, value, label_values=()):
+        """Record the value for the label values."""
+        entry = self.values.get(label_values)
+        if entry is None:
+            entry = self.values[label_values] = [
+                [0] * (len(self.buckets) + 1), 0, 0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def samples(self):
+        """Yield (name, label names, label values, value) of the samples."""
+        names = self.label_names + ('le',)
+        for label_values, (counts, total, count) in sorted(
+                self.values.items()):
+            cumulative = 0
+            bounds = self.buckets + (float('inf'),)
+            for bound, bucket_count in zip(bounds, counts):
+                cumulative += bucket_count
+                yield (self.name + '_bucket', names,
+                       label_values + (_format_value(bound),), cumulative)
+            yield (self.name + '_sum', self.label_names, label_values, total)
+            yield (self.name + '_count', self.label_names, label_values,
+                   count)
+
+
+class Gauge(object):
+    """A gauge read by a function when it is exported."""
+    type = 'gauge'
+
+    def __init__(self, name, help, label_names=(), read=None):
+        """
+        args:
+            name(str);
+            help(str);
+            label_names(tuple of str, default=());
+            read(callable, default=None):
+                Return a list of (label values, value). Nothing is exported
+                if it is None.
+        """
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.read = read
+
+    def samples(self):
+        """Yield (name, label names, label values, value) of the samples."""
+        if self.read is None:
+            return
+        for label_values, value in self.read():
+            yield (self.name, self.label_names, label_values, value)
+
+
+class Registry(object):
+    """The metrics exported together."""
+    def __init__(self):
+        self.metrics = []
+        #The labels added to every sample, such as the worker id.
+        self.const_labels = {}
+
+    def add(self, metric):
+        """Add the metric and return it."""
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Return the metrics in the text format of Prometheus (unicode)."""
+        const_names = tuple(sorted(self.const_labels))
+        const_values = tuple(self.const_labels[name] for name in const_names)
+        lines = []
+        for metric in self.metrics:
+            lines.append(u'# HELP {0} {1}'.format(metric.name, metric.help))
+            lines.append(u'# TYPE {0} {1}'.format(metric.name, metric.type))
+            for name, label_names, label_values, value in metric.samples():
+                lines.append(u'{0}{1} {2}'.format(
+                    name,
+                    _format_labels(const_names + label_names,
+                                   const_values + tuple(label_values)),
+                    _format_value(value)))
+        return u'\n'.join(lines) + u'\n'
+
+
+class QueryStats(object):
+    """How many queries a scope made and how many seconds they took."""
+    __slots__ = ('count', 'seconds')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+
+#If the metrics are recorded. See enable.
+enabled = False
+
+registry = Registry()
+
+request_seconds = registry.add(Histogram(
+    'blog_request_seconds',
+    'The seconds handling a request.',
+    ('handler', 'method')))
+responses = registry.add(Counter(
+    'blog_responses_total',
+    'The responses by the status code.',
+    ('handler', 'code')))
+request_queries = registry.add(Histogram(
+    'blog_request_db_queries',
+    'The database queries made by a request.',
+    ('handler',), QUERY_BUCKETS))
+request_query_seconds = registry.add(Histogram(
+    'blog_request_db_seconds',
+    'The seconds the database queries of a request took.',
+    ('handler',)))
+render_seconds = registry.add(Histogram(
+    'blog_render_seconds',
+    'The seconds rendering a template.',
+    ('template',)))
+session_entries = registry.add(Gauge(
+    'blog_session_entries',
+    'The sessions in the session storage.'))
+session_bytes = registry.add(Gauge(
+    'blog_session_bytes',
+    'The approximate bytes of the sessions in the memory storage.'))
+page_cache_bytes = registry.add(Gauge(
+    'blog_page_cache_bytes',
+    'The bytes of the pages in the page cache.'))
+user_cache_entries = registry.add(Gauge(
+    'blog_user_cache_entries',
+    'The users in the user cache.'))
+
+
+def enable():
+    """Record the metrics from now on."""
+    global enabled
+    enabled = True
+
+
+def instrument_engine(engine, current_scope):
+    """Count the queries of the engine on the QueryStats of their scope.
+
+    The queries are counted if the scope has a query_stats attribute. Nothing
+    is listened if the metrics aren't enabled.
+    args:
+        engine(sqlalchemy.engine.Engine);
+        current_scope(callable):
+            Return the scope of the running query, such as the request
+            handler passed to model.run_in_scope.
+    """
+    if not enabled:
+        return
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context,
+                              executemany):
+        conn.info.setdefault('query_start_time', []).append(time.time())
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context,
+                             executemany):
+        seconds = time.time() - conn.info['query_start_time'].pop()
+        stats = getattr(current_scope(), 'query_stats', None)
+        if stats is not None:
+            stats.count += 1
+            stats.seconds += seconds
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+
+
+def watch_context(ctx, user_cache):
+    """Read the gauges from the context of the application.
+
+    args:
+        ctx(tornado.util.ObjectDict):
+            The context with the session_manager and the page_cache.
+        user_cache(model.UserCache).
+    """
+    storage = ctx.session_manager.storage
+
+    def read_session_bytes():
+        if not hasattr(storage, 'stats'):
+            return []
+        return [((), storage.stats()['bytes'])]
+
+    session_entries.read = lambda: [((), len(storage))]
+    session_bytes.read = read_session_bytes
+    page_cache_bytes.read = lambda: [((), ctx.page_cache.stats()['bytes'])]
+    user_cache_entries.read = lambda: [((), user_cache.stats()['entries'])]
+
+
+def record_request(handler_name, method, code, seconds, query_stats=None):
+    """Record a finished request.
+
+    args:
+        handler_name(str):
+            The class name of the handler.
+        method(str);
+        code(int):
+            The status code of the response.
+        seconds(float);
+        query_stats(QueryStats, default=None):
+            The queries made by the request.
+    """
+    request_seconds.observe(seconds, (handler_name, method))
+    responses.inc((handler_name, code))
+    if query_stats is not None:
+        request_queries.observe(query_stats.count, (handler_name,))
+        request_query_seconds.observe(query_stats.seconds, (handler_name,))
@@ -3,45 +3,262 @@
 
 """The datamodel of the blog application.
 
-The module will create an engine and a session according to the database
-options. And It will try to create all tables if necessary. It also provide
+Importing the module doesn't connect to the database. The engine is created
+by init_engine, or by get_engine when the database is first accessed,
+according to the database options. So load the config before that, see
+blog.bootstrap. The tables are created and upgraded by
+`python migrate.py upgrade`, not by importing the module. It also provide
 some function like commit and rollback. Please use them first although you can
 use session's method as well.
+
+Database access blocks, so the handlers should not call the models on the
+IOLoop directly. Use run_in_executor to run them on the executor instead.
+
+The session is scoped. Functions run by run_in_scope share one session per
+scope (a request, usually) until close_scope is called, so the identity map
+lives as long as the request and a failed commit only affects that request.
+
+If read replicas are configured, a session reads from one of them, chosen
+round-robin, and writes to the primary. A session reads from the primary
+once it has written, and so does the scope which has read_primary_until set
+in the future, such as the handler of a visitor who has written recently
+(see BlogSession), so the visitor making a change sees it at once.
 """
 
+import bisect
+import collections
 import datetime
+import itertools
+import thread
+import threading
+import time
 
+from concurrent import futures
 from sqlalchemy import create_engine
+from sqlalchemy import event
+from sqlalchemy import exc
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import Column
 from sqlalchemy import types
 from sqlalchemy import ForeignKey
+from sqlalchemy import Index
+from sqlalchemy import and_
+from sqlalchemy import or_
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session as SQLAlchemySession
+from sqlalchemy.orm import scoped_session
 from sqlalchemy.orm import relationship
 from sqlalchemy.orm import backref
+from sqlalchemy.orm import deferred
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import undefer
+from sqlalchemy.orm import object_session
+from sqlalchemy.sql import expression
 
 import markdown2
 
+import metrics
+import passwords
+import slow_queries
 import utils
 from options import options
 
-#Prepare the engine instance.
-url_pattern = 'mysql+pymysql://{user}:{pwd}@{host}/{dbname}'
-url = url_pattern.format(user=options.db_user,
-                         pwd=options.db_pwd,
-                         host=options.db_address,
-                         dbname=options.db_name,
-                         )
+url_pattern = 'mysql+pymysql://{user}:{pwd}@{host}:{port}/{dbname}'
+
+#The engine created by init_engine. It is None until the database is used.
+engine = None
+#The engines of the read replicas created by init_engine.
+replicas = []
+_replica_counter = itertools.count()
+#The executor created by get_executor.
+executor = None
+_init_lock = threading.Lock()
+
+
+def options_url():
+    """Return the db_url option, or the URL made by the other database
+    options if it is empty.
+    """
+    if options.db_url:
+        return options.db_url
+    return url_pattern.format(user=options.db_user,
+                              pwd=options.db_pwd,
+                              host=options.db_address,
+                              port=options.db_port,
+                              dbname=options.db_name,
+                              )
+
+
+def init_engine(url=None, replica_urls=None):
+    """Create the engines if they haven't been created, and return the
+    engine of the primary.
+
+    args:
+        url(str, default=None):
+            The database URL. If it is None, use options_url().
+        replica_urls(list of str, default=None):
+            The URLs of the read replicas. If it is None, use the
+            db_replica_urls option when url is None too, or no replica.
+    return(sqlalchemy.engine.Engine).
+    """
+    global engine
+    with _init_lock:
+        if engine is not None:
+            return engine
+        if url is None:
+            url = options_url()
+            if replica_urls is None:
+                replica_urls = options.db_replica_urls
+        replicas[:] = [_create_engine(replica_url)
+                       for replica_url in replica_urls or ()]
+        engine = _create_engine(url)
+        return engine
+
+
+def _create_engine(url):
+    """Create an engine by the database options and instrument it.
+
+    The pool options aren't used by SQLite, which has its own pools. A SQLite
+    connection can be used by any executor thread, because the functions of a
+    scope may run on different threads one after another.
+    """
+    if url.startswith('sqlite'):
+        new_engine = create_engine(
+            url,
+            echo=options.debug,
+            connect_args=dict(check_same_thread=False))
+    else:
+        new_engine = create_engine(url,
+                                   echo=options.debug,
+                                   connect_args=dict(charset='utf8'),
+                                   pool_size=options.db_pool_size,
+                                   max_overflow=options.db_max_overflow,
+                                   pool_timeout=options.db_pool_timeout,
+                                   pool_recycle=options.db_pool_recycle,
+                                   )
+        if options.db_pool_pre_ping:
+            event.listen(new_engine, 'checkout', _ping_connection)
+    metrics.instrument_engine(new_engine, current_scope)
+    slow_queries.log.instrument_engine(new_engine, current_scope)
+    return new_engine
+
+
+def get_engine():
+    """Return the engine, create it by the options if necessary."""
+    return engine if engine is not None else init_engine()
+
+
+def get_replica():
+    """Return the engine of the next replica, or None if there is none."""
+    get_engine()
+    if not replicas:
+        return None
+    return replicas[next(_replica_counter) % len(replicas)]
+
+
+def dispose_engines():
+    """Close the connections of the engines, such as after forking."""
+    for created_engine in [engine] + replicas:
+        if created_engine is not None:
+            created_engine.dispose()
+
+
+def get_executor():
+    """Return the executor running the blocking database access, create it
+    if necessary.
+    """
+    global executor
+    if executor is None:
+        with _init_lock:
+            if executor is None:
+                executor = futures.ThreadPoolExecutor(
+                    options.db_executor_workers)
+    return executor
+
+
+def _ping_connection(dbapi_connection, connection_record, connection_proxy):
+    """Make sure the connection checked out from the pool is alive.
+
+    If the ping fails, the pool will drop the connection and try another one.
+    """
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('SELECT 1')
+    except Exception:
+        raise exc.DisconnectionError()
+    finally:
+        cursor.close()
+
+
+#Prepare the session registry. Every scope gets its own session, so
+#concurrent requests never share one. Objects stay usable after the session
+#is closed because they are handed back to the IOLoop thread.
+_local = threading.local()
 
 
-engine = create_engine(url,
-                       echo=options.debug,
-                       connect_args=dict(charset='utf8')
-                       )
+def _current_scope():
+    """Return the scope of the running function, or the current thread."""
+    return getattr(_local, 'scope', None) or thread.get_ident()
 
-#Prepare the session instance.
-Session = sessionmaker(bind=engine)
-session = Session()
+
+def current_scope():
+    """Return the scope of the function run by run_in_scope, or None."""
+    return getattr(_local, 'scope', None)
+
+
+class BlogSession(SQLAlchemySession):
+    """The session using the engines of get_engine and get_replica, so the
+    engines are created when the first session needs them.
+
+    The SELECTs go to a replica chosen once for the session, so the reads of
+    a session see one replica. The flushes, the other statements and the
+    SELECT ... FOR UPDATE go to the primary, and so does everything after
+    the session has written, or before the read_primary_until time of the
+    scope (a handler, usually) if it has one.
+
+    A commit which has written sets the wrote_at attribute of the scope to
+    the time if it has one, so the handler can keep the visitor reading from
+    the primary in the next requests.
+    """
+    #If the session has written to the primary.
+    wrote = False
+    #The engine of the replica the session reads from.
+    replica = None
+
+    def get_bind(self, mapper=None, clause=None):
+        if self.bind is not None:
+            return super(BlogSession, self).get_bind(mapper, clause)
+        if self._flushing or isinstance(clause, expression.UpdateBase):
+            self.wrote = True
+            return get_engine()
+        if (self.wrote or not isinstance(clause, expression.SelectBase) or
+                getattr(clause, 'for_update', False) or
+                time.time() < getattr(current_scope(),
+                                      'read_primary_until', 0)):
+            return get_engine()
+        if self.replica is None:
+            self.replica = get_replica()
+        return self.replica or get_engine()
+
+    def commit(self):
+        """Commit, and record the time on the scope if it has written."""
+        super(BlogSession, self).commit()
+        scope = current_scope()
+        if self.wrote and replicas and hasattr(scope, 'wrote_at'):
+            scope.wrote_at = time.time()
+
+Session = sessionmaker(class_=BlogSession, expire_on_commit=False)
+session = scoped_session(Session, scopefunc=_current_scope)
+
+
+def session_stats():
+    """Return a dict of how many sessions are open in the registry, and how
+    many objects their identity maps hold.
+    """
+    sessions = list(session.registry.registry.values())
+    return dict(sessions=len(sessions),
+                identities=sum(len(db_session.identity_map)
+                               for db_session in sessions))
 
 
 #Prepare the superclass of model class.
@@ -64,6 +281,18 @@ class BaseModel(object):
         """
         return session.query(cls).filter_by(**conditions)
 
+    @classmethod
+    def exists_filter_by(cls, **conditions):
+        """Is there any object meeting the conditions?
+
+        args:
+            conditions.
+        return(bool):
+            True if one or more objects meet the conditions, or False.
+        """
+        query = cls.query_filter_by(**conditions)
+        return session.query(query.exists()).scalar()
+
     @classmethod
     def count(cls):
         """Return how many objects there are."""
@@ -74,6 +303,183 @@ class BaseModel(object):
         """Offset offset and return a list having less than limit+1 object"""
         return session.query(cls).offset(offset).limit(limit).all()
 
+    @classmethod
+    def seek(cls, key_columns, after=None, limit=20, descending=True,
+             query=None):
+        """Keyset pagination. Return the objects following the key after.
+
+        Unlike part, it doesn't scan the skipped rows, so a deep page costs
+        the same as the first one.
+        args:
+            key_columns(sequence of Column):
+                The columns ordering the objects. They should identify an
+                object together, such as (submit_time, id).
+            after(tuple, default=None):
+                The values of key_columns of the last object of the previous
+                page. If it is None, return the first page.
+            limit(int, default=20):
+                How many objects a page has at most.
+            descending(bool, default=True):
+                Order the objects by key_columns descending or ascending.
+            query(Query, default=None):
+                The query to page, such as a filtered one. Use
+                session.query(cls) if it is None.
+        return(list):
+            A list having less than limit+1 object.
+        """
+        return cls.seek_query(key_columns, after, limit, descending,
+                              query).all()
+
+    @classmethod
+    def seek_query(cls, key_columns, after=None, limit=20, descending=True,
+                   query=None):
+        """Return the query of seek, see it."""
+        if query is None:
+            query = session.query(cls)
+        if after is not None:
+            query = query.filter(_keyset_condition(key_columns, after,
+                                                   descending))
+        if descending:
+            order = [column.desc() for column in key_columns]
+        else:
+            order = list(key_columns)
+        return query.order_by(*order).limit(limit)
+
+
+def _keyset_condition(columns, values, descending):
+    """Return the condition that a row's key comes after values.
+
+    The row comparison is expanded to (c1 < v1 OR (c1 = v1 AND c2 < v2)), so
+    that MySQL can use the index on the columns.
+    """
+    column, value = columns[0], values[0]
+    beyond = column < value if descending else column > value
+    if len(columns) == 1:
+        return beyond
+    rest = _keyset_condition(columns[1:], values[1:], descending)
+    return or_(beyond, and_(column == value, rest))
+
+
+class KeyIndex(object):
+    """A cached and sorted list of the keys of all objects of a model.
+
+    It tells how many objects there are and which key a page starts after
+    without querying the database, so page numbers can be used with seek.
+    Load it once and keep it up to date by add after committing new objects.
+    It is loaded again after ttl seconds, so the objects added by others,
+    such as the migrations or another host, are found too. The keys added
+    shortly before are kept by a load, because it may read a replica which
+    doesn't have them yet.
+    """
+    def __init__(self, key_columns, ttl=0, lag=0):
+        """
+        args:
+            key_columns(callable):
+                Return the columns of the key. It is called when loading, so
+                the columns can be taken from a model defined later.
+            ttl(int, default=0):
+                How many seconds the keys are kept before loading them again.
+                0 keeps them for ever.
+            lag(int, default=0):
+                How many seconds the database loaded from may lag behind the
+                added keys, such as a read replica.
+        """
+        self.key_columns = key_columns
+        self.ttl = ttl
+        self.lag = lag
+        self.keys = None
+        self.loaded_time = None
+        #How many loads are running, and (the time, the key) of the keys
+        #added lately or while they run, which their results may miss.
+        self.loading = 0
+        self.added = collections.deque()
+        self.lock = threading.Lock()
+
+    def configure(self, ttl, lag=0):
+        self.ttl = ttl
+        self.lag = lag
+
+    def load(self):
+        """Load the keys from the database if they haven't been loaded or
+        have expired.
+
+        The query runs out of the lock, so add doesn't wait for it. While the
+        expired keys are loaded again, the others keep using them.
+        """
+        with self.lock:
+            if self.keys is not None and (
+                    self.loading or not self.ttl or
+                    time.time() - self.loaded_time < self.ttl):
+                return
+            self.loading += 1
+        try:
+            start = time.time()
+            columns = self.key_columns()
+            rows = session.query(*columns).order_by(*columns).all()
+            keys = [tuple(row) for row in rows]
+        finally:
+            with self.lock:
+                self.loading -= 1
+        with self.lock:
+            for added_time, key in self.added:
+                if added_time >= start - self.lag:
+                    self._insert(keys, key)
+            self.keys = keys
+            self.loaded_time = start
+            self._forget_added(time.time())
+
+    def add(self, key):
+        """Add the key of a committed object, if it hasn't been added. It is
+        merged into the loads which may miss it too.
+        """
+        key = tuple(key)
+        now = time.time()
+        with self.lock:
+            self._forget_added(now)
+            self.added.append((now, key))
+            if self.keys is not None:
+                self._insert(self.keys, key)
+
+    def _forget_added(self, now):
+        """Forget the keys added too long ago for a load to miss them. Keep
+        them all while a load is running.
+        """
+        if self.loading:
+            return
+        while self.added and self.added[0][0] < now - self.lag:
+            self.added.popleft()
+
+    def _insert(self, keys, key):
+        """Insert the key into the sorted keys if it isn't there."""
+        position = bisect.bisect_left(keys, key)
+        if position == len(keys) or keys[position] != key:
+            keys.insert(position, key)
+
+    def count(self):
+        """Return how many objects there are."""
+        self.load()
+        return len(self.keys)
+
+    def key_before(self, position):
+        """Return the key before the position, in descending order.
+
+        args:
+            position(int):
+                How many objects are before the page, such as (page-1)*20.
+        return(tuple or None):
+            The key to pass to seek as after. None if position is 0.
+        """
+        self.load()
+        if position <= 0:
+            return None
+        position = min(position, len(self.keys))
+        return self.keys[len(self.keys) - position]
+
+    def position_after(self, key):
+        """Return how many objects are before and at the key, descending."""
+        self.load()
+        return len(self.keys) - bisect.bisect_left(self.keys, tuple(key))
+
 
 Base = declarative_base(cls=BaseModel)
 
@@ -90,7 +496,8 @@ class User(Base):
     #The base information of an account.
     id = Column(types.Integer, primary_key=True)
     email = Column(types.String(128), unique=True, nullable=False)
-    password = Column(types.String(64), nullable=False)
+    #The algorithm, cost, salt and hash, see the passwords module.
+    password = Column(types.String(128), nullable=False)
     nickname = Column(types.String(64), unique=True, nullable=False)
     status = Column(types.Enum('host', 'admin', 'user'), nullable=False)
     register_time = Column(types.DateTime, nullable=False)
@@ -108,6 +515,7 @@ class User(Base):
                  status='user',
                  register_time=None,
                  id=None,
+                 password_hash=None,
                  ):
         """
         args:
@@ -115,8 +523,10 @@ class User(Base):
                 The email adress of the user. Should less than 128 bytes long.
             password(basestring):
                 The raw password of the user. The __init__ method will
-                calculate and store its hash value automatically. Use
-                last_login_time (left out microsencond) as salt.
+                calculate and store its hash value automatically, by the
+                password_algorithm and password_iterations options. It is
+                slow, so hash it by a passwords.PasswordHasher and pass
+                password_hash instead off the IOLoop.
             nickname(basestring):
                 The nickname of the user. Should less than 64 bytes long.
             register_ip(basestring):
@@ -146,6 +556,9 @@ class User(Base):
             id(int, default=auto_increase):
                 The id of the user. Use None will use a new id created by
                 session when commit.
+            password_hash(str, default=None):
+                The hash of the password made by the passwords module. If it
+                is not None, the password is ignored.
         """
         self.email = email
         if len(str(email)) > 128:
@@ -169,11 +582,34 @@ class User(Base):
         self.last_login_time = utils.remove_microsecond(last_login_time)
 
         #Get password's hash value.
-        digest = self.get_password_hash(password)
-        self.password = digest
+        if password_hash is None:
+            password_hash = passwords.hash_password(
+                password,
+                algorithm=options.password_algorithm,
+                iterations=options.password_iterations)
+        self.password = password_hash
+
+    @property
+    def legacy_salts(self):
+        """The salt_pre and salt_suf of the legacy password hash."""
+        return (str(self.register_time), str(self.register_ip))
+
+    def check_password(self, password):
+        """Return if the raw password is the user's.
+
+        It is slow, verify by a passwords.PasswordHasher off the IOLoop
+        instead if possible.
+        """
+        matched, _ = passwords.verify_password(
+            password, self.password, self.legacy_salts)
+        return matched
 
     def get_password_hash(self, password):
-        """Get a password's hash value and use user's some attributes as salt.
+        """Get a password's legacy hash value and use user's some attributes
+        as salt.
+
+        The passwords are hashed by the passwords module now. It is used to
+        verify the passwords stored before.
 
         args:
             password(str):
@@ -247,6 +683,26 @@ class User(Base):
         """
         return cls.query_filter_by(id=id).order_by(cls.id).first()
 
+    @classmethod
+    def get_cached(cls, id):
+        """Get user by user's id through the user_cache.
+
+        If the user isn't cached, load it and cache it. The user returned is
+        detached from the session, read it only.
+        args:
+            id(int):
+                The id of user.
+        return(User or None):
+            The user, or None if no user have the id.
+        """
+        user = user_cache.get(id)
+        if user is None:
+            user = cls.get_user_by_id(id)
+            if user is not None:
+                session.expunge(user)
+                user_cache.put(user)
+        return user
+
     @classmethod
     def get_user_by_email(cls, email):
         """Get user by user's email.
@@ -273,8 +729,7 @@ class User(Base):
             user have the email.
         """
         user = cls.get_user_by_email(email)
-        if user is not None and (user.get_password_hash(password) ==
-                                 user.password):
+        if user is not None and user.check_password(password):
             return user
         else:
             return None
@@ -317,7 +772,7 @@ class User(Base):
         return(bool):
             True if we have a user with the id. Otherwise, return False.
         """
-        return cls.query_filter_by(id=id).exists()
+        return cls.exists_filter_by(id=id)
 
     @classmethod
     def have_user_with_email(cls, email):
@@ -329,7 +784,7 @@ class User(Base):
         return(bool):
             True if we have a user with the email. Otherwise, return False.
         """
-        return cls.query_filter_by(email=email).exists()
+        return cls.exists_filter_by(email=email)
 
     @classmethod
     def have_user_with_nickname(cls, nickname):
@@ -341,13 +796,17 @@ class User(Base):
         return(bool):
             True if we have a user with the nickname. Otherwise, return False.
         """
-        return cls.query_filter_by(nickname=nickname).exists()
+        return cls.exists_filter_by(nickname=nickname)
 
 
 class Article(Base):
     """The class of a article object that defining its structure.
 
     Use self.author to get the user object representing the author.
+
+    The raw and content are large, so they are deferred: they are loaded when
+    used, which needs the session. Use get_article with with_content=True to
+    load the content with the article. The lists use the summary instead.
     """
 
     __tablename__ = 'articles'
@@ -357,14 +816,21 @@ class Article(Base):
     title = Column(types.String(128), unique=True, nullable=False)
     title_for_url = Column(types.String(128), unique=True, nullable=False)
 
+    #The foreign keys are indexed by the 0004 migration, or by MySQL itself.
     author_id = Column(types.Integer, ForeignKey('users.id'))
     #Relationship betweem user and article. Needn't init.
     author = relationship(User, backref=backref('articles', order_by=id))
 
-    raw = Column(types.Text, nullable=True)
-    content = Column(types.Text, nullable=True)
+    raw = deferred(Column(types.Text, nullable=True))
+    content = deferred(Column(types.Text, nullable=True))
+    #The plain text beginning of the content, see utils.summarize.
+    summary = Column(types.String(1024), nullable=True)
     submit_time = Column(types.DateTime, nullable=False)
 
+    #The index of the key ordering the article lists.
+    __table_args__ = (Index('ix_articles_submit_time_id', 'submit_time', 'id'),
+                      )
+
     def __init__(self,
                  title,
                  title_for_url,
@@ -385,14 +851,14 @@ class Article(Base):
                 The raw content of the article (such as the markdown file's
                 content).
             author(User, default=None):
-                the author of the article. This method will add itself to the
-                user's articles list automatically if author is not None.
+                the author of the article. The article is added to the user's
+                articles list by the backref, which isn't loaded for it.
             converter(callable):
                 It's necessary if content need converting from raw. Will use
                 converter(raw) to convert.
             content(basestring, default=None):
                 The content of the article. If it is None, this function will
-                convert the raw to content.
+                convert the raw to content. The summary is made from it.
             submit_time(datetime.datetime, default=datetime.datetime.utcnow()):
                 When the author submit the time? Should be a UTC time. If it is
                 None, this method will use datetime.datetime.utcnow(). And the
@@ -407,12 +873,82 @@ class Article(Base):
         self.raw = raw
 
         self.content = content or utils.content_convert(raw, converter)
+        self.summary = utils.summarize(self.content)
 
         submit_time = submit_time or datetime.datetime.utcnow()
         self.submit_time = utils.remove_microsecond(submit_time)
 
         if author is not None:
-            author.articles.append(self)
+            self.author = author
+
+    @property
+    def key(self):
+        """The key ordering articles, newest first."""
+        return (self.submit_time, self.id)
+
+    @property
+    def cursor(self):
+        """The key in a string which can be used in urls."""
+        return '{0}-{1}'.format(self.submit_time.strftime('%Y%m%d%H%M%S'),
+                                self.id)
+
+    @classmethod
+    def parse_cursor(cls, cursor):
+        """Get the key from a cursor.
+
+        args:
+            cursor(basestring):
+                The cursor of an article.
+        return(tuple):
+            The key of the article.
+        raise:
+            ValueError: if the cursor is malformed.
+        """
+        submit_time, _, id = cursor.partition('-')
+        return (datetime.datetime.strptime(submit_time, '%Y%m%d%H%M%S'),
+                int(id))
+
+    @classmethod
+    def key_columns(cls):
+        """Return the columns of the key."""
+        return (cls.submit_time, cls.id)
+
+    @classmethod
+    def count(cls):
+        """Return how many articles there are. Use the cached index."""
+        return cls.index.count()
+
+    @classmethod
+    def page_after(cls, key=None, limit=20):
+        """Return the articles after the key, newest first.
+
+        Their authors are loaded by the same query, so a page costs one query
+        however many authors it shows.
+        args:
+            key(tuple, default=None):
+                The key of the last article of the previous page. If it is
+                None, return the newest articles.
+            limit(int, default=20):
+                How many articles a page has at most.
+        return(list).
+        """
+        query = session.query(cls).options(joinedload(cls.author))
+        return cls.seek(cls.key_columns(), key, limit, query=query)
+
+    @classmethod
+    def page(cls, page, limit=20):
+        """Return the articles of the page, newest first.
+
+        It uses the cached index to find the key the page starts after, so
+        it doesn't scan the articles of the previous pages.
+        args:
+            page(int):
+                The page number, starting from 1.
+            limit(int, default=20):
+                How many articles a page has at most.
+        return(list).
+        """
+        return cls.page_after(cls.index.key_before((page - 1) * limit), limit)
 
     def __repr__(self):
         str_patter = ''.join(('<Article(',
@@ -430,30 +966,45 @@ class Article(Base):
                                  )
 
     @classmethod
-    def get_article(cls, identification):
+    def get_article(cls, identification, with_author=False,
+                    with_content=False):
         """Get user by the identification.
 
         Now it just is an alias of get_article_by_title_for_url.
         args:
             identification(basestring):
                 The title_for_url of the article.
+            with_author(bool, default=False):
+                Load the author by the same query.
+            with_content(bool, default=False):
+                Load the deferred content by the same query.
         return(Article or None):
             Return the Article found by the identification or None.
         """
-        return cls.get_article_by_title_for_url(identification)
+        return cls.get_article_by_title_for_url(identification, with_author,
+                                                with_content)
 
     @classmethod
-    def get_article_by_title_for_url(cls, title_for_url):
+    def get_article_by_title_for_url(cls, title_for_url, with_author=False,
+                                     with_content=False):
         """Get user by the title_for_url.
 
         args:
             title_for_url(basestring):
                 The title_for_url of the article.
+            with_author(bool, default=False):
+                Load the author by the same query.
+            with_content(bool, default=False):
+                Load the deferred content by the same query.
         return(Article or None):
             Return the Article found by the identification or None.
         """
-        return (cls.query_filter_by(title_for_url=title_for_url).
-                order_by(cls.id).first())
+        query = cls.query_filter_by(title_for_url=title_for_url)
+        if with_author:
+            query = query.options(joinedload(cls.author))
+        if with_content:
+            query = query.options(undefer(cls.content))
+        return query.order_by(cls.id).first()
 
     @classmethod
     def have_article(cls, identification):
@@ -478,21 +1029,127 @@ class Article(Base):
         return(bool):
             True if have one or more article with the title_for_url, or False.
         """
-        return cls.query_filter_by(title_for_url=title_for_url).exists()
+        return cls.exists_filter_by(title_for_url=title_for_url)
+
+
+class UserCache(object):
+    """A LRU cache of the users by id. The cached users expire after ttl.
+
+    The cached users are detached from any session, so the requests can share
+    them. Read them only; merge one into a session before modifying it. The
+    users updated or deleted by a flush are invalidated automatically.
+
+    It is thread safe.
+    """
+    def __init__(self, max_entries, ttl):
+        """
+        args:
+            max_entries(int):
+                How many users are cached at most. Use 0 to cache nothing.
+            ttl(int or float):
+                How many seconds a user is cached.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, max_entries, ttl):
+        """Change the size and ttl, and drop the cached users."""
+        with self.lock:
+            self.max_entries = max_entries
+            self.ttl = ttl
+            self.entries.clear()
+
+    def get(self, id):
+        """Return the cached user with id, or None."""
+        with self.lock:
+            entry = self.entries.pop(id, None)
+            if entry is None or entry[1] < time.time():
+                self.misses += 1
+                return None
+            #Move it to the end, it is the most recently used now.
+            self.entries[id] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, user):
+        """Cache the user. It should be detached."""
+        if self.max_entries <= 0:
+            return
+        with self.lock:
+            self.entries.pop(user.id, None)
+            self.entries[user.id] = (user, time.time() + self.ttl)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, id):
+        """Drop the user with id if it is cached."""
+        with self.lock:
+            self.entries.pop(id, None)
+
+    def clear(self):
+        """Drop every user."""
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """Return a dict of the size and the counters of the cache."""
+        with self.lock:
+            return dict(entries=len(self.entries),
+                        hits=self.hits,
+                        misses=self.misses,
+                        )
+
+
+#The users looked up by the request handlers. It is configured again when the
+#config is loaded, see blog.bootstrap.
+user_cache = UserCache(max_entries=options.user_cache_size,
+                       ttl=options.user_cache_ttl)
+
+
+@event.listens_for(User, 'after_update')
+def _invalidate_updated_user(mapper, connection, target):
+    """Drop the user updated from the user_cache.
+
+    A user is flushed when an article or comment is added to its collections
+    too, so only the changes of its columns count.
+    """
+    db_session = object_session(target)
+    if (db_session is None or
+            db_session.is_modified(target, include_collections=False)):
+        user_cache.invalidate(target.id)
+
+
+@event.listens_for(User, 'after_delete')
+def _invalidate_deleted_user(mapper, connection, target):
+    """Drop the user deleted from the user_cache."""
+    user_cache.invalidate(target.id)
+
+
+#The cached keys of the articles. ArticleSubmitHandler adds the new ones. It
+#is configured when the config is loaded, see blog.bootstrap.
+Article.index = KeyIndex(Article.key_columns)
 
 
 class Comment(Base):
-    """Class of a comment."""
+    """Class of a comment.
+
+    The raw is only used to make the content, so it is deferred.
+    """
     __tablename__ = 'comments'
 
     #Base information of a comment.
     id = Column(types.Integer, primary_key=True)
 
+    #The foreign keys are indexed by the 0004 migration, or by MySQL itself.
     author_id = Column(types.Integer, ForeignKey('users.id'))
     #Relationship betweem Comment and User.
     author = relationship(User, backref=backref('comments', order_by=id))
 
-    raw = Column(types.Text, nullable=False)
+    raw = deferred(Column(types.Text, nullable=False))
     content = Column(types.Text, nullable=False)
     submit_time = Column(types.DateTime, nullable=False)
 
@@ -519,11 +1176,11 @@ class Comment(Base):
                 convert the raw and use the result as the content
                 automatically.
             author(User, default=None):
-                The author of the comment. If it is not None, __init__ will
-                append the comment to author's comments attribute.
+                The author of the comment. The comment is added to author's
+                comments attribute by the backref, which isn't loaded for it.
             article(Article, default=None):
-                The article which own this comment. __init__ will append the
-                comment to article.comments if article is not None.
+                The article which own this comment. The comment is added to
+                article.comments by the backref, which isn't loaded for it.
             converter(callable):
                 It's necessary if content need converting from raw. Will use
                 converter(raw) to convert.
@@ -542,9 +1199,37 @@ class Comment(Base):
         if id is not None:
             self.id = id
         if author is not None:
-            author.comments.append(self)
+            self.author = author
         if article is not None:
-            article.comments.append(self)
+            self.article = article
+
+    @classmethod
+    def page_of_article(cls, article_id, after=None, limit=50):
+        """Return the comments of the article after a comment, oldest first.
+
+        Their authors are loaded by the same query, so a page costs one query
+        however many comments it has.
+        args:
+            article_id(int):
+                The id of the article.
+            after(int, default=None):
+                The id of the last comment of the previous page. If it is None,
+                return the first page.
+            limit(int, default=50):
+                How many comments a page has at most.
+        return(list).
+        """
+        return cls.page_of_article_query(article_id, after, limit).all()
+
+    @classmethod
+    def page_of_article_query(cls, article_id, after=None, limit=50):
+        """Return the query of page_of_article, see it."""
+        query = (session.query(cls).
+                 options(joinedload(cls.author)).
+                 filter(cls.article_id == article_id))
+        key = (after,) if after is not None else None
+        return cls.seek_query((cls.id,), key, limit, descending=False,
+                              query=query)
 
     def __repr__(self):
         str_patter = ''.join(('<Comment(',
@@ -560,9 +1245,6 @@ class Comment(Base):
                                  )
 
 
-Base.metadata.create_all(engine)
-
-
 #Some alias of the session's method, please use these alias first.
 def commit():
     """Use the commit method of the session to commit every change."""
@@ -572,3 +1254,67 @@ def commit():
 def rollback():
     """Use this to rollback."""
     session.rollback()
+
+
+def run_in_executor(func, *args, **kwargs):
+    """Run func(*args, **kwargs) on the database executor.
+
+    Every call is a unit of work: the session will be closed when func
+    returns, so the objects returned are detached and func should commit its
+    changes itself. If func raises, the session will be rolled back before
+    the exception is passed to the future.
+    args:
+        func(callable):
+            The function accessing the database.
+        *args, **kwargs:
+            The arguments passed to func.
+    return(concurrent.futures.Future):
+        The future of func's result. It can be yielded in a tornado coroutine.
+    """
+    return get_executor().submit(_call_in_scope, None, func, *args, **kwargs)
+
+
+def run_in_scope(scope, func, *args, **kwargs):
+    """Run func(*args, **kwargs) on the database executor within a scope.
+
+    The functions run within the same scope share one session, which will be
+    kept until close_scope(scope) is called. If func raises, the session will
+    be rolled back before the exception is passed to the future. Don't run two
+    functions of the same scope at the same time.
+    args:
+        scope(hashable):
+            The key of the scope, such as the request handler.
+        func(callable):
+            The function accessing the database.
+        *args, **kwargs:
+            The arguments passed to func.
+    return(concurrent.futures.Future):
+        The future of func's result.
+    """
+    return get_executor().submit(_call_in_scope, scope, func, *args, **kwargs)
+
+
+def close_scope(scope):
+    """Close the session of the scope and return its connection to the pool.
+
+    Closing may talk to the database, so it is done on the executor as well.
+    return(concurrent.futures.Future).
+    """
+    return get_executor().submit(_call_in_scope, scope, session.remove)
+
+
+def _call_in_scope(scope, func, *args, **kwargs):
+    """Call func within the scope and rollback if anything goes wrong.
+
+    If scope is None, use a temporary one and close its session finally.
+    """
+    _local.scope = scope if scope is not None else object()
+    try:
+        return func(*args, **kwargs)
+    except Exception:
+        rollback()
+        raise
+    finally:
+        if scope is None:
+            session.remove()
+        _local.scope = None
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module hashes and verifies the passwords of the users.
+
+A password is stored with its algorithm and cost:
+    pbkdf2_sha256$<iterations>$<salt>$<hash>
+so the cost can be raised and the old hashes still be verified. The hashes
+without '$' are the legacy ones made by utils.hash_repeat, salted by the
+register time and IP address of the user.
+
+Hashing is slow on purpose, so it runs on the executor of a PasswordHasher,
+off the IOLoop and the database executor.
+"""
+
+import base64
+import hashlib
+import hmac
+import os
+
+from concurrent import futures
+
+import utils
+
+
+#The algorithms can be used to hash the new passwords.
+ALGORITHMS = ('pbkdf2_sha256',)
+
+
+def hash_password(password, algorithm='pbkdf2_sha256', iterations=100000,
+                  salt=None):
+    """Hash the password and return it with its algorithm, cost and salt.
+
+    args:
+        password(basestring);
+        algorithm(str, default='pbkdf2_sha256'):
+            One of ALGORITHMS.
+        iterations(int, default=100000):
+            The cost of the algorithm.
+        salt(str, default=None):
+            Use a new random salt if it is None.
+    return(str):
+        The encoded hash.
+    raise:
+        ValueError: if the algorithm is unknown.
+    """
+    if algorithm not in ALGORITHMS:
+        raise ValueError('Unknown password algorithm {0}.'.format(algorithm))
+    if salt is None:
+        salt = base64.b64encode(os.urandom(12))
+    if isinstance(password, unicode):
+        password = password.encode('utf-8')
+    digest = hashlib.pbkdf2_hmac('sha256', password, salt, iterations)
+    return '$'.join((algorithm, str(iterations), salt,
+                     base64.b64encode(digest)))
+
+
+def verify_password(password, encoded, legacy_salts=('', ''),
+                    algorithm='pbkdf2_sha256', iterations=100000):
+    """Check the password, and rehash it if its hash is outdated.
+
+    args:
+        password(basestring):
+            The raw password.
+        encoded(str):
+            The stored hash.
+        legacy_salts(tuple, default=('', '')):
+            The salt_pre and salt_suf of a legacy hash.
+        algorithm(str, default='pbkdf2_sha256');
+        iterations(int, default=100000):
+            The algorithm and cost the password should be hashed with.
+    return(tuple):
+        (matched, new_encoded). new_encoded is the hash to store instead if
+        the password matched but was hashed by another algorithm or cost,
+        otherwise it is None.
+    """
+    #The hashes are ASCII, but are unicode when loaded from the database.
+    encoded = str(encoded)
+    if '$' not in encoded:
+        salt_pre, salt_suf = legacy_salts
+        expected = utils.hash_repeat(password, salt_pre=salt_pre,
+                                     salt_suf=salt_suf)
+    else:
+        stored_algorithm, stored_iterations, salt, _ = encoded.split('$', 3)
+        expected = hash_password(password, stored_algorithm,
+                                 int(stored_iterations), salt)
+    #Compare in constant time.
+    if not hmac.compare_digest(str(expected), encoded):
+        return (False, None)
+    if needs_rehash(encoded, algorithm, iterations):
+        return (True, hash_password(password, algorithm, iterations))
+    return (True, None)
+
+
+def needs_rehash(encoded, algorithm='pbkdf2_sha256', iterations=100000):
+    """Return if the hash isn't made by the algorithm and cost."""
+    parts = encoded.split('$')
+    return (len(parts) != 4 or parts[0] != algorithm or
+            parts[1] != str(iterations))
+
+
+class PasswordHasher(object):
+    """Hash and verify the passwords on a dedicated executor.
+
+    The executor is created on the first use, so a hasher created before the
+    workers are forked doesn't share its threads or processes with them.
+    """
+    def __init__(self, algorithm='pbkdf2_sha256', iterations=100000,
+                 workers=2, use_processes=False):
+        """
+        args:
+            algorithm(str, default='pbkdf2_sha256'):
+                The algorithm of the new hashes. One of ALGORITHMS.
+            iterations(int, default=100000):
+                The cost of the new hashes.
+            workers(int, default=2):
+                How many threads or processes hash the passwords.
+            use_processes(bool, default=False):
+                Hash in processes instead of threads. The threads are enough
+                if hashlib releases the GIL while hashing.
+        raise:
+            ValueError: if the algorithm is unknown.
+        """
+        if algorithm not in ALGORITHMS:
+            raise ValueError('Unknown password algorithm {0}.'.format(
+                algorithm))
+        self.algorithm = algorithm
+        self.iterations = iterations
+        self.workers = workers
+        self.use_processes = use_processes
+        self.executor = None
+
+    def hash(self, password):
+        """Return the future of the hash of the password."""
+        return self._submit(hash_password, password, self.algorithm,
+                            self.iterations)
+
+    def verify(self, password, encoded, legacy_salts=('', '')):
+        """Return the future of (matched, new_encoded), see verify_password.
+        """
+        return self._submit(verify_password, password, encoded, legacy_salts,
+                            self.algorithm, self.iterations)
+
+    def shutdown(self):
+        """Shut down the executor if it has been created."""
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def _submit(self, func, *args):
+        """Submit func(*args) to the executor, create it if necessary."""
+        if self.executor is None:
+            if self.use_processes:
+                self.executor = futures.ProcessPoolExecutor(self.workers)
+            else:
+                self.executor = futures.ThreadPoolExecutor(self.workers)
+        return self.executor.submit(func, *args)
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module profiles the live requests on demand.
+
+A request is profiled by cProfile if it carries a signed profile token (see
+ProfileHandler), or if it is sampled by the rate set for its handler. The
+IOLoop thread is profiled from prepare to on_finish, and every function the
+request runs on the database executor is profiled in its thread, then the
+profiles are merged and dumped to the profile directory:
+    <time>-<pid>-<n>-<handler>.prof  the pstats file, for pstats or snakeviz;
+    <time>-<pid>-<n>-<handler>.txt   the functions taking the most time.
+
+Only one request of a process is profiled at a time, because the profile of
+the IOLoop thread includes whatever runs on it meanwhile, such as the
+callbacks of the other requests. The requests not profiled only check a few
+attributes, nothing is hooked into the interpreter.
+"""
+
+import cProfile
+import cStringIO
+import os
+import pstats
+import random
+import re
+import threading
+import time
+
+
+#The names of the dumps, safe to be used in the urls.
+DUMP_NAME_PATTERN = re.compile(r'^[\w.-]+\.(prof|txt)$')
+#How many functions the text report lists.
+REPORT_LINES = 60
+
+
+class RequestProfile(object):
+    """The profile of a request."""
+    def __init__(self, handler_name, route):
+        """
+        args:
+            handler_name(str):
+                The class name of the handler.
+            route(str):
+                The method and path of the request.
+        """
+        self.handler_name = handler_name
+        self.route = route
+        self.start_time = time.time()
+        self.profile = cProfile.Profile()
+        #The profiles of the functions run on the database executor.
+        self.db_profiles = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Profile the current thread (the IOLoop thread)."""
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def wrap(self, func):
+        """Return a function running func under a profile of its thread."""
+        def profiled(*args, **kwargs):
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(func, *args, **kwargs)
+            finally:
+                with self.lock:
+                    self.db_profiles.append(profile)
+        return profiled
+
+    def stats(self):
+        """Return the pstats.Stats merging every profile."""
+        stats = pstats.Stats(self.profile)
+        with self.lock:
+            for profile in self.db_profiles:
+                stats.add(profile)
+        return stats
+
+    def report(self, stats):
+        """Return the text report of the stats."""
+        stream = cStringIO.StringIO()
+        stream.write('{0} by {1}, {2:.1f} ms, {3} database calls\n'.format(
+            self.route, self.handler_name,
+            (time.time() - self.start_time) * 1000, len(self.db_profiles)))
+        stats.stream = stream
+        stats.sort_stats('cumulative').print_stats(REPORT_LINES)
+        return stream.getvalue()
+
+
+class Profiler(object):
+    """Decide which requests are profiled, and keep their dumps.
+
+    Use it on the IOLoop only, except RequestProfile.wrap.
+    """
+    def __init__(self, directory='profiles', max_dumps=50):
+        """
+        args:
+            directory(str, default='profiles'):
+                Where the profiles are dumped. The workers can share it.
+            max_dumps(int, default=50):
+                How many profiles are kept, the oldest ones are removed.
+        """
+        self.directory = directory
+        self.max_dumps = max_dumps
+        #The class name of the handler to the fraction of its requests
+        #profiled.
+        self.sample_rates = {}
+        #The profile running, only one at a time.
+        self.active = None
+        #How many profiles this process has dumped.
+        self.dumped = 0
+
+    def configure(self, directory, max_dumps):
+        self.directory = directory
+        self.max_dumps = max_dumps
+
+    def set_sample_rate(self, handler_name, rate):
+        """Profile the fraction of the handler's requests. 0 stops it."""
+        if rate > 0:
+            self.sample_rates[handler_name] = min(rate, 1.0)
+        else:
+            self.sample_rates.pop(handler_name, None)
+
+    def sampled(self, handler_name):
+        """Return if the request of the handler is sampled."""
+        if not self.sample_rates:
+            return False
+        rate = self.sample_rates.get(handler_name)
+        return rate is not None and random.random() < rate
+
+    def start(self, handler_name, route):
+        """Start profiling a request.
+
+        return(RequestProfile or None):
+            None if another request is being profiled.
+        """
+        if self.active is not None:
+            return None
+        self.active = RequestProfile(handler_name, route)
+        self.active.start()
+        return self.active
+
+    def finish(self, profile):
+        """Stop the profile and dump it.
+
+        return(str):
+            The name of the pstats dump.
+        """
+        profile.stop()
+        if self.active is profile:
+            self.active = None
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.dumped += 1
+        base = '{0}-{1}-{2}-{3}'.format(
+            time.strftime('%Y%m%d%H%M%S', time.localtime(profile.start_time)),
+            os.getpid(), self.dumped, profile.handler_name)
+        stats = profile.stats()
+        stats.dump_stats(os.path.join(self.directory, base + '.prof'))
+        with open(os.path.join(self.directory, base + '.txt'), 'w') as f:
+            f.write(profile.report(stats))
+        self._remove_old_dumps()
+        return base + '.prof'
+
+    def dumps(self):
+        """Return the dumps as a list of dict(name, bytes, time), the latest
+        first.
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        dumps = []
+        for name in os.listdir(self.directory):
+            if not DUMP_NAME_PATTERN.match(name):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                #Removed by another worker.
+                continue
+            dumps.append(dict(name=name, bytes=stat.st_size,
+                              time=stat.st_mtime))
+        dumps.sort(key=lambda dump: (dump['time'], dump['name']),
+                   reverse=True)
+        return dumps
+
+    def path_of(self, name):
+        """Return the path of the dump, or None if there is no such one."""
+        if not DUMP_NAME_PATTERN.match(name):
+            return None
+        path = os.path.join(self.directory, name)
+        return path if os.path.isfile(path) else None
+
+    def _remove_old_dumps(self):
+        """Remove the oldest profiles beyond max_dumps."""
+        bases = []
+        for dump in self.dumps():
+            base = os.path.splitext(dump['name'])[0]
+            if base not in bases:
+                bases.append(base)
+        for base in bases[self.max_dumps:]:
+            for extension in ('.prof', '.txt'):
+                try:
+                    os.remove(os.path.join(self.directory, base + extension))
+                except OSError:
+                    pass
+
+
+#The profiler of this process. It is configured when the config is loaded,
+#see blog.bootstrap.
+profiler = Profiler()
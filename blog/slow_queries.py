@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module records the slow queries of the blog.
+
+A query taking longer than the threshold is logged with its parameters and
+the handler and route of the request making it, and kept in a bounded ring
+buffer read by the admin page. The plan of a slow SELECT is captured by
+EXPLAIN on another connection of a dedicated thread, so the request doesn't
+wait for it. The plans are cached by the statement, a statement slow again
+and again is explained once.
+"""
+
+import collections
+import logging
+import threading
+import time
+
+from concurrent import futures
+from sqlalchemy import event
+
+
+#The longest parameters kept, in characters of their repr.
+MAX_PARAMETERS_LENGTH = 300
+#How many plans are cached.
+MAX_PLANS = 100
+
+
+def explain(connection, statement, parameters=()):
+    """Return the plan of the statement.
+
+    args:
+        connection(sqlalchemy.engine.Connection);
+        statement(basestring):
+            The statement compiled for the database, with its placeholders.
+        parameters(tuple or dict, default=()):
+            The parameters of the placeholders.
+    return(tuple):
+        (the column names, the rows) of the plan.
+    """
+    if connection.dialect.name == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    else:
+        prefix = 'EXPLAIN '
+    result = connection.execute(prefix + statement, parameters)
+    return (list(result.keys()), [list(row) for row in result])
+
+
+class SlowQueryLog(object):
+    """A ring buffer of the slow queries.
+
+    Every entry is a dict of:
+        time(float): when the query finished;
+        seconds(float);
+        statement(unicode);
+        parameters(unicode): the repr of the parameters, maybe truncated;
+        handler(str): the class name of the handler, or None;
+        route(str): the method and path of the request, or None;
+        plan(dict): {'columns': [...], 'rows': [...]}, or None until it is
+            captured or if the statement isn't a SELECT;
+        explain_error(unicode): why the plan can't be captured, or None.
+    It is thread safe.
+    """
+    def __init__(self, threshold=0.1, max_entries=100):
+        """
+        args:
+            threshold(float, default=0.1):
+                The queries taking longer than this many seconds are slow. 0
+                disables the log.
+            max_entries(int, default=100):
+                How many slow queries are kept, the older ones are dropped.
+        """
+        self.threshold = threshold
+        self.entries = collections.deque(maxlen=max_entries)
+        self.plans = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.executor = None
+        self.recorded = 0
+        self._local = threading.local()
+
+    def configure(self, threshold, max_entries):
+        """Change the threshold and the size, and drop the entries."""
+        with self.lock:
+            self.threshold = threshold
+            self.entries = collections.deque(maxlen=max_entries)
+
+    def instrument_engine(self, engine, current_scope):
+        """Time the queries of the engine and record the slow ones.
+
+        Nothing is listened if the log is disabled.
+        args:
+            engine(sqlalchemy.engine.Engine);
+            current_scope(callable):
+                Return the scope of the running query, such as the request
+                handler passed to model.run_in_scope.
+        """
+        if self.threshold <= 0:
+            return
+
+        def before_cursor_execute(conn, cursor, statement, parameters,
+                                  context, executemany):
+            conn.info.setdefault('slow_query_start', []).append(time.time())
+
+        def after_cursor_execute(conn, cursor, statement, parameters,
+                                 context, executemany):
+            seconds = time.time() - conn.info['slow_query_start'].pop()
+            if (seconds >= self.threshold and
+                    not getattr(self._local, 'explaining', False)):
+                self.record(engine, statement, parameters, seconds,
+                            current_scope(), explain=not executemany)
+
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+
+    def record(self, engine, statement, parameters, seconds, scope=None,
+               explain=True):
+        """Log the slow query, keep it and capture its plan.
+
+        args:
+            engine(sqlalchemy.engine.Engine):
+                The engine explaining the query.
+            statement(basestring);
+            parameters(tuple or dict);
+            seconds(float);
+            scope(object, default=None):
+                The request handler making the query, or another scope.
+            explain(bool, default=True):
+                If capture the plan. Only the SELECTs are explained anyway.
+        return(dict):
+            The entry.
+        """
+        request = getattr(scope, 'request', None)
+        parameters_repr = repr(parameters)
+        if len(parameters_repr) > MAX_PARAMETERS_LENGTH:
+            parameters_repr = parameters_repr[:MAX_PARAMETERS_LENGTH] + '...'
+        entry = dict(time=time.time(),
+                     seconds=seconds,
+                     statement=unicode(statement),
+                     parameters=parameters_repr,
+                     handler=(type(scope).__name__
+                              if request is not None else None),
+                     route=('{0} {1}'.format(request.method, request.path)
+                            if request is not None else None),
+                     plan=None,
+                     explain_error=None,
+                     )
+        logging.warning('Slow query (%.1f ms) from %s: %s %s',
+                        seconds * 1000, entry['route'] or 'no request',
+                        entry['statement'], parameters_repr)
+
+        explain = explain and statement.lstrip()[:6].upper() == 'SELECT'
+        with self.lock:
+            self.entries.append(entry)
+            self.recorded += 1
+            if explain:
+                entry['plan'] = self.plans.get(statement)
+        if explain and entry['plan'] is None:
+            self._submit(self._explain, engine, statement, parameters, entry)
+        return entry
+
+    def snapshot(self):
+        """Return a list of the entries, the latest first."""
+        with self.lock:
+            return [dict(entry) for entry in reversed(self.entries)]
+
+    def stats(self):
+        """Return a dict of the threshold, the entries kept and recorded."""
+        with self.lock:
+            return dict(threshold=self.threshold,
+                        entries=len(self.entries),
+                        recorded=self.recorded,
+                        )
+
+    def shutdown(self):
+        """Shut down the thread explaining the queries if it is started."""
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def _submit(self, func, *args):
+        """Submit func(*args) to the executor, create it if necessary."""
+        with self.lock:
+            if self.executor is None:
+                self.executor = futures.ThreadPoolExecutor(1)
+            executor = self.executor
+        return executor.submit(func, *args)
+
+    def _explain(self, engine, statement, parameters, entry):
+        """Capture the plan of the statement on a new connection."""
+        self._local.explaining = True
+        try:
+            connection = engine.connect()
+            try:
+                columns, rows = explain(connection, statement, parameters)
+            finally:
+                connection.close()
+        except Exception as e:
+            entry['explain_error'] = unicode(e)
+            return
+        finally:
+            self._local.explaining = False
+        plan = dict(columns=columns,
+                    rows=[[unicode(value) for value in row] for row in rows])
+        with self.lock:
+            entry['plan'] = plan
+            self.plans[statement] = plan
+            while len(self.plans) > MAX_PLANS:
+                self.plans.popitem(last=False)
+
+
+#The slow queries of this process. It is configured when the config is
+#loaded, see blog.bootstrap.
+log = SlowQueryLog()
@@ -25,6 +25,15 @@ urls = [url(r'/?', handlers.HomeHandler, name='home'),
             name='submit_article'),
         url(r'/submit/comment/?', handlers.CommentSubmitHandler,
             name='submit_comment'),
+        url(r'/admin/metrics/?', handlers.MetricsHandler,
+            name='admin_metrics'),
+        url(r'/admin/slow-queries/?', handlers.SlowQueryHandler,
+            name='admin_slow_queries'),
+        url(r'/admin/profiles/?', handlers.ProfileHandler,
+            name='admin_profiles'),
+        url(r'/admin/profiles/([\w.-]+)', handlers.ProfileDumpHandler,
+            name='admin_profile'),
+        url(r'/admin/memory/?', handlers.MemoryHandler, name='admin_memory'),
         #Handle every request out of urls and return a 404 status code.
         url(r'.*', web.ErrorHandler, dict(status_code=404)),
         ]
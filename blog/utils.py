@@ -5,6 +5,8 @@
 import hashlib
 import datetime
 import functools
+import HTMLParser
+import re
 import urllib
 
 import markdown2
@@ -57,6 +59,31 @@ def content_convert(raw, converter=markdown2.markdown):
     return converter(raw).encode('utf-8')
 
 
+def summarize(content, length=300):
+    """Return the plain text summary of the converted content.
+
+    The HTML tags are removed, and the text is cut at a word boundary if it is
+    longer than length.
+    args:
+        content(basestring):
+            The converted content, such as the result of content_convert.
+        length(int, default=300):
+            How many characters the summary has at most, without the ellipsis.
+    return(unicode):
+        The summary.
+    """
+    if isinstance(content, str):
+        content = content.decode('utf-8')
+    text = HTMLParser.HTMLParser().unescape(re.sub(r'<[^>]*>', ' ', content))
+    text = u' '.join(text.split())
+    if len(text) <= length:
+        return text
+    cut = text.rfind(u' ', 0, length + 1)
+    if cut <= 0:
+        cut = length
+    return text[:cut].rstrip() + u'\u2026'
+
+
 def apply_args_to_converter(converter, *args, **kwargs):
     """Apply args to a converter (callable).
 
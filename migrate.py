@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+The migrate.py creates and upgrades the tables of the blog. Run it before
+starting the server.py, and after updating the blog:
+    python migrate.py status            Show the applied and pending ones.
+    python migrate.py upgrade [VERSION] Apply the pending migrations.
+    python migrate.py explain           Show the plans of the main queries.
+
+The migrations are the files named like 0004_indexes.py in the migrations
+directory, applied in the order of their version (the number). A migration
+has an upgrade(connection) function. The applied versions are recorded in the
+schema_version table.
+
+The 0001 migration creates the missing tables from the current models, so a
+new database has everything already. The later migrations must check what
+exists before changing the schema.
+
+Use --explain with upgrade to show the plans of the main queries before and
+after the upgrade. The queries using the columns not added yet can't be
+explained before.
+"""
+
+import argparse
+import datetime
+import glob
+import imp
+import os
+
+import sqlalchemy
+from sqlalchemy import exc
+from sqlalchemy import Column
+from sqlalchemy import MetaData
+from sqlalchemy import Table
+from sqlalchemy import types
+
+import blog
+from blog import model
+from blog import slow_queries
+
+
+#The directory of the migrations.
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'migrations')
+
+metadata = MetaData()
+#The versions applied.
+schema_version = Table('schema_version', metadata,
+                       Column('version', types.Integer, primary_key=True,
+                              autoincrement=False),
+                       Column('name', types.String(128), nullable=False),
+                       Column('applied_time', types.DateTime, nullable=False),
+                       )
+
+
+def load_migrations():
+    """Load the migrations in the order of their versions.
+
+    return(list):
+        A list of (version, name, module).
+    """
+    migrations = []
+    for path in glob.glob(os.path.join(MIGRATIONS_DIR, '[0-9]*_*.py')):
+        name = os.path.splitext(os.path.basename(path))[0]
+        version = int(name.split('_', 1)[0])
+        module = imp.load_source('migration_{0}'.format(name), path)
+        migrations.append((version, name, module))
+    migrations.sort()
+    return migrations
+
+
+def applied_versions(connection):
+    """Return the set of the versions applied."""
+    schema_version.create(connection, checkfirst=True)
+    rows = connection.execute(sqlalchemy.select([schema_version.c.version]))
+    return set(row[0] for row in rows)
+
+
+def upgrade(connection, target=None):
+    """Apply the pending migrations up to the target version.
+
+    args:
+        connection(sqlalchemy.engine.Connection);
+        target(int, default=None):
+            Apply all of them if it is None.
+    return(list):
+        The names of the migrations applied.
+    """
+    applied = applied_versions(connection)
+    names = []
+    for version, name, module in load_migrations():
+        if version in applied or (target is not None and version > target):
+            continue
+        module.upgrade(connection)
+        connection.execute(schema_version.insert().values(
+            version=version,
+            name=name,
+            applied_time=datetime.datetime.utcnow()))
+        names.append(name)
+    return names
+
+
+def main_queries():
+    """Return the main queries of the models as a list of (title, query)."""
+    Article = model.Article
+    Comment = model.Comment
+    some_time = datetime.datetime(2013, 9, 14)
+    return [
+        ('article list, first page',
+         Article.seek_query(Article.key_columns())),
+        ('article list, after a cursor',
+         Article.seek_query(Article.key_columns(), (some_time, 1))),
+        ('article index load',
+         model.session.query(*Article.key_columns()).
+         order_by(*Article.key_columns())),
+        ('article by title_for_url',
+         model.session.query(Article).filter_by(title_for_url='hello').
+         order_by(Article.id).limit(1)),
+        ('comments of an article',
+         Comment.page_of_article_query(1, 1)),
+        ('articles of a user',
+         model.session.query(Article).filter(Article.author_id == 1).
+         order_by(Article.id)),
+        ('comments of a user',
+         model.session.query(Comment).filter(Comment.author_id == 1).
+         order_by(Comment.id)),
+    ]
+
+
+def explain(connection):
+    """Print the plans of the main queries.
+
+    A query can't be explained if it uses a column the pending migrations
+    add, then the error is printed instead.
+    """
+    for title, query in main_queries():
+        compiled = query.statement.compile(dialect=connection.dialect)
+        if compiled.positional:
+            params = tuple(compiled.params[name]
+                           for name in compiled.positiontup)
+        else:
+            params = compiled.params
+        print '--', title
+        try:
+            columns, rows = slow_queries.explain(connection, unicode(compiled),
+                                                 params)
+        except exc.DBAPIError as e:
+            print '   cannot explain: {0}'.format(e.orig)
+            continue
+        print '   ' + ' | '.join(columns)
+        for row in rows:
+            print '   ' + ' | '.join(unicode(value) for value in row)
+    model.session.remove()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Create and upgrade the tables of the blog.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('status', help='Show the applied and pending ones.')
+    upgrade_parser = subparsers.add_parser(
+        'upgrade', help='Apply the pending migrations.')
+    upgrade_parser.add_argument('version', type=int, nargs='?',
+                                help='Upgrade to this version only.')
+    upgrade_parser.add_argument('--explain', action='store_true',
+                                help='Show the plans before and after.')
+    subparsers.add_parser('explain', help='Show the plans of the main queries.')
+    args = parser.parse_args()
+
+    blog.bootstrap()
+    connection = model.get_engine().connect()
+    try:
+        if args.command == 'status':
+            applied = applied_versions(connection)
+            for version, name, module in load_migrations():
+                state = 'applied' if version in applied else 'pending'
+                print '{0:8} {1}'.format(state, name)
+        elif args.command == 'upgrade':
+            if (args.explain and
+                    connection.dialect.has_table(connection, 'articles')):
+                print 'Before:'
+                explain(connection)
+            names = upgrade(connection, args.version)
+            for name in names:
+                print 'Applied {0}.'.format(name)
+            if not names:
+                print 'Nothing to apply.'
+            if args.explain:
+                print 'After:'
+                explain(connection)
+        elif args.command == 'explain':
+            explain(connection)
+    finally:
+        connection.close()
+
+
+if __name__ == '__main__':
+    main()
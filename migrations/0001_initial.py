@@ -0,0 +1,16 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Create the tables which don't exist.
+
+A new database gets the tables of the current models, with every column and
+index but the indexes of the foreign keys (see 0004), so the later migrations
+find nothing else to do. The existing tables are left alone, the later
+migrations upgrade them.
+"""
+
+from blog import model
+
+
+def upgrade(connection):
+    """Create the missing tables."""
+    model.Base.metadata.create_all(connection, checkfirst=True)
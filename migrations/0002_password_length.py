@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Widen the password column of the users.
+
+The passwords are stored with their algorithm, cost and salt now, which
+don't fit in 64 characters.
+"""
+
+import sqlalchemy
+
+
+def upgrade(connection):
+    """Widen users.password to 128 characters."""
+    inspector = sqlalchemy.inspect(connection)
+    for column in inspector.get_columns('users'):
+        if column['name'] == 'password':
+            length = getattr(column['type'], 'length', None)
+            break
+    #SQLite doesn't limit the length, and can't modify a column.
+    if connection.dialect.name == 'mysql' and length < 128:
+        connection.execute('ALTER TABLE users '
+                           'MODIFY password VARCHAR(128) NOT NULL')
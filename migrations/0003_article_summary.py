@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Add the summary column of the articles and backfill it.
+
+The article lists show the summary instead of loading the content. The
+articles submitted before it was added have no summary, so make them from
+their content in small batches, which don't lock the table for long.
+"""
+
+import sqlalchemy
+from sqlalchemy import and_
+from sqlalchemy import select
+
+from blog import model
+from blog import utils
+
+
+def upgrade(connection):
+    """Add the summary column if necessary, then backfill it.
+
+    return(int):
+        How many articles are updated.
+    """
+    inspector = sqlalchemy.inspect(connection)
+    columns = [column['name'] for column in inspector.get_columns('articles')]
+    if 'summary' not in columns:
+        connection.execute('ALTER TABLE articles '
+                           'ADD COLUMN summary VARCHAR(1024) NULL')
+    return backfill(connection)
+
+
+def backfill(connection, batch=100):
+    """Make the summaries of the articles having none.
+
+    return(int):
+        How many articles are updated.
+    """
+    articles = model.Article.__table__
+    last_id = 0
+    updated = 0
+    while True:
+        with connection.begin():
+            rows = connection.execute(
+                select([articles.c.id, articles.c.content]).
+                where(and_(articles.c.id > last_id,
+                           articles.c.summary == None)).
+                order_by(articles.c.id).
+                limit(batch)).fetchall()
+            for id, content in rows:
+                connection.execute(
+                    articles.update().
+                    where(articles.c.id == id).
+                    values(summary=utils.summarize(content or '')))
+        if not rows:
+            return updated
+        updated += len(rows)
+        last_id = rows[-1][0]
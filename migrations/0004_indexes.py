@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Add the indexes of the columns the lookups and the article lists use.
+
+The comments and articles of a user, the comments of an article and the
+article lists (ordered by submit_time and id) scanned the whole tables.
+MySQL builds the indexes online, the tables can still be written meanwhile.
+InnoDB indexes every foreign key column itself, so only the index of the
+article lists is added on MySQL. The other databases get the indexes of the
+foreign keys here, the models don't declare them.
+"""
+
+import sqlalchemy
+
+
+#The table, the name and the columns of the indexes, and if the columns are
+#a foreign key.
+INDEXES = (('comments', 'ix_comments_article_id', ('article_id',), True),
+           ('comments', 'ix_comments_author_id', ('author_id',), True),
+           ('articles', 'ix_articles_author_id', ('author_id',), True),
+           ('articles', 'ix_articles_submit_time_id', ('submit_time', 'id'),
+            False),
+           )
+
+
+def upgrade(connection):
+    """Create the indexes which don't exist."""
+    inspector = sqlalchemy.inspect(connection)
+    mysql = connection.dialect.name == 'mysql'
+    for table, name, columns, foreign_key in INDEXES:
+        if foreign_key and mysql:
+            continue
+        existing = [index['name'] for index in inspector.get_indexes(table)]
+        if name in existing:
+            continue
+        if mysql:
+            sql = ('ALTER TABLE {0} ADD INDEX {1} ({2}), '
+                   'ALGORITHM=INPLACE, LOCK=NONE')
+        else:
+            sql = 'CREATE INDEX {1} ON {0} ({2})'
+        connection.execute(sql.format(table, name, ', '.join(columns)))
@@ -1,67 +1,346 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 """
-The server.py will start a HTTPServer instance listening the 80 port. So you
-can use `python server.py` to start you httpserver (and the blog).
+The server.py will start HTTPServer instances listening the server_port (80 by
+default). So you can use `python server.py` to start you httpserver (and the
+blog).
 
-It will create a context object containing a Cron Runer and a Session Manager for
-the application. If the script exit after the context being created, it will clean
-the context (stop the Cron Runner) automatically.
+If the server_workers option is more than 1, the server forks the workers and
+supervises them: every worker runs its own IOLoop and HTTPServer, the workers
+exited unexpectedly are respawned, and the signals stopping the server are
+forwarded to the workers. Every worker binds its own socket with SO_REUSEPORT
+if the system supports it, so the kernel balances the connections between
+them. Otherwise the socket is bound before forking and shared.
+
+Every worker will create a context object containing a Session Manager for
+the application, and the worker 0 runs a Cron Runner in its context too. If
+the worker exit after the context being created, it will clean the context
+(stop the Cron Runner) automatically.
 """
 
 import datetime
+import errno
+import logging
+import os
+import signal
+import socket
+import time
 
 from tornado import httpserver
 from tornado import ioloop
+from tornado import log
+from tornado import netutil
+from tornado import process
 from tornado import util
 
 import cron
 import session
 
+import blog
 from blog import application
+from blog import bus
+from blog import context
+from blog import memory
+from blog import metrics
+from blog import model
+from blog import slow_queries
+from blog.options import options
+
+
+#The workers exit sooner than this many seconds after started are respawned
+#after a delay, so a broken worker won't be forked again and again.
+RESPAWN_DELAY = 1
+
+
+def create_session_storage():
+    """Create the session storage chosen by the session_storage option."""
+    if options.session_storage == 'memory':
+        return session.MemorySessionStorage(
+            max_entries=options.session_max_entries,
+            max_bytes=options.session_max_bytes)
+    elif options.session_storage == 'sqlite':
+        return session.SQLiteSessionStorage(options.session_db_path)
+    else:
+        raise ValueError('Unknown session storage {0}.'.format(
+            options.session_storage))
+
 
+def prepare(run_cron=True):
+    """Prepare the context object containing SessionManager, CronRunner and
+    the InvalidationBus of this worker.
 
-def prepare():
-    """Prepare the context object containing SessionManager and CronRunner."""
+    It loads the config if it hasn't been loaded. If the template_warmup
+    option is True, it loads all the templates before the worker accepts the
+    connections.
+
+    args:
+        run_cron(bool, default=True):
+            If create and start the cron runner. Only one worker runs it, and
+            the others' ctx.cron_runner is None.
+    """
+    blog.bootstrap()
     ctx = util.ObjectDict()
 
     #Prepare the SessionManager.
-    ctx.session_manager = session.SessionManager()
+    ctx.session_manager = session.SessionManager(
+        storage=create_session_storage())
     #Create and start a cron task runner.
-    ctx.cron_runner = cron.Cron()
-    ctx.cron_runner.start()
+    ctx.cron_runner = None
+    if run_cron:
+        ctx.cron_runner = cron.Cron()
+        ctx.cron_runner.start()
+        #Take the memory snapshots on this IOLoop, which owns the session
+        #storage, when the cron says.
+        if options.memory_snapshot_minutes > 0:
+            memory.telemetry.interval_minutes = options.memory_snapshot_minutes
+            io_loop = ioloop.IOLoop.current()
+            ctx.cron_runner.add_timer_task(
+                lambda: io_loop.add_callback(memory.telemetry.snapshot),
+                datetime.timedelta(minutes=options.memory_snapshot_minutes))
+    #Receive the changes of the other workers on the current IOLoop.
+    ctx.bus = bus.InvalidationBus(options.bus_dir)
+    ctx.bus.start()
+
+    if options.template_warmup:
+        start = time.time()
+        loaded = context.warm_up_templates(
+            context.init_context().template_lookup)
+        logging.info('%d templates loaded in %.3f seconds.', loaded,
+                     time.time() - start)
 
     return ctx
 
 
 def clean(ctx):
-    """Clean up the context. It will stop and close the cron_runner."""
-    ctx.cron_runner.stop()
-    ctx.cron_runner.join()
-    ctx.cron_runner.close()
+    """Clean up the context.
 
+    It will stop and close the cron_runner, the bus, the password hasher and
+    the thread explaining the slow queries, then write the saved sessions and
+    close the session storage.
+    """
+    ctx.bus.close()
+    slow_queries.log.shutdown()
+    #It is added by the Application.
+    if 'password_hasher' in ctx:
+        ctx.password_hasher.shutdown()
+    if ctx.cron_runner is not None:
+        ctx.cron_runner.stop()
+        ctx.cron_runner.join()
+        ctx.cron_runner.close()
+    ctx.session_manager.close()
 
-def main():
-    """Main fuction which will start a HTTPServer listening the 80 port
 
-    It also clean context finally. If you use the blog without start the main
-    fuction, please invoke the clean function yourself.
+def bind_sockets(port, address=None, reuse_port=False, backlog=128):
+    """Create the listening sockets bound to the port and address.
+
+    It works like tornado.netutil.bind_sockets, which can't set SO_REUSEPORT.
+    args:
+        port(int);
+        address(str, default=None):
+            The IP address or hostname. Listen on all interfaces if it is
+            empty or None.
+        reuse_port(bool, default=False):
+            Set SO_REUSEPORT, so other processes can bind the same port.
+        backlog(int, default=128).
+    return(list of socket.socket).
+    """
+    if not address:
+        address = None
+    family = socket.AF_UNSPEC if socket.has_ipv6 else socket.AF_INET
+    sockets = []
+    for res in set(socket.getaddrinfo(address, port, family,
+                                      socket.SOCK_STREAM, 0,
+                                      socket.AI_PASSIVE)):
+        af, socktype, proto, canonname, sockaddr = res
+        try:
+            sock = socket.socket(af, socktype, proto)
+        except socket.error as e:
+            if e.args[0] == errno.EAFNOSUPPORT:
+                continue
+            raise
+        netutil.set_close_exec(sock.fileno())
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if af == socket.AF_INET6:
+            #Use a separate IPv4 socket, like tornado does.
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+        sock.setblocking(0)
+        sock.bind(sockaddr)
+        sock.listen(backlog)
+        sockets.append(sock)
+    return sockets
+
+
+def serve(worker_id=0, sockets=None):
+    """Serve the blog in this process until SIGTERM or SIGINT.
+
+    args:
+        worker_id(int, default=0):
+            The worker 0 runs the cron runner.
+        sockets(list of socket.socket, default=None):
+            The listening sockets. If it's None, bind the sockets by the
+            server_port and server_address options with SO_REUSEPORT.
     """
     ctx = None
     try:
-        ctx = prepare()
-        #Clean expired session once an hour.
-        ctx.cron_runner.add_timer_task(ctx.session_manager.clean_expired_session,
-                                       datetime.timedelta(hours=1))
+        if sockets is None:
+            sockets = bind_sockets(options.server_port,
+                                   options.server_address,
+                                   reuse_port=True)
+        ctx = prepare(run_cron=worker_id == 0)
+        #Every worker keeps its own metrics.
+        metrics.registry.const_labels['worker'] = str(worker_id)
+        memory.telemetry.worker = worker_id
+        #Clean expired session once a minute. It only visits the expiring
+        #sessions, and runs on the IOLoop which owns the session storage, so
+        #every worker cleans its own.
+        io_loop = ioloop.IOLoop.instance()
+        clean_task = ioloop.PeriodicCallback(
+            ctx.session_manager.clean_expired_session,
+            datetime.timedelta(minutes=1).total_seconds() * 1000,
+            io_loop=io_loop)
+        clean_task.start()
 
         http_server = httpserver.HTTPServer(application.Application(ctx))
-        http_server.listen(80)
+        http_server.add_sockets(sockets)
+
+        def stop():
+            """Stop accepting connections and stop the IOLoop."""
+            http_server.stop()
+            io_loop.stop()
+
+        def handle_signal(signum, frame):
+            io_loop.add_callback_from_signal(stop)
 
-        print 'HTTPServer listening 80 will start now.'
-        ioloop.IOLoop.instance().start()
+        signal.signal(signal.SIGTERM, handle_signal)
+        signal.signal(signal.SIGINT, handle_signal)
+
+        logging.info('Worker %d (pid %d) will start now.',
+                     worker_id, os.getpid())
+        io_loop.start()
     finally:
         if ctx is not None:
             clean(ctx)
 
+
+class Supervisor(object):
+    """Fork the workers and respawn the ones exited unexpectedly.
+
+    SIGTERM and SIGINT are forwarded to the workers, and run returns when all
+    of them have exited.
+    """
+    def __init__(self, workers, sockets=None):
+        """
+        args:
+            workers(int):
+                How many workers to fork.
+            sockets(list of socket.socket, default=None):
+                The sockets shared by the workers. If it's None, every worker
+                binds its own with SO_REUSEPORT.
+        """
+        self.workers = workers
+        self.sockets = sockets
+        #The pid to the worker id of the running workers.
+        self.children = {}
+        self.start_times = {}
+        self.stopping = False
+
+    def run(self):
+        """Fork the workers and supervise them until they have all exited."""
+        signal.signal(signal.SIGTERM, self.handle_signal)
+        signal.signal(signal.SIGINT, self.handle_signal)
+        for worker_id in range(self.workers):
+            self.spawn(worker_id)
+
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except OSError as e:
+                #Interrupted by a signal.
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            worker_id = self.children.pop(pid, None)
+            if worker_id is None or self.stopping:
+                continue
+
+            logging.warning('Worker %d (pid %d) exited with status %d, '
+                            'respawn it.', worker_id, pid, status)
+            if time.time() - self.start_times[worker_id] < RESPAWN_DELAY:
+                time.sleep(RESPAWN_DELAY)
+            if not self.stopping:
+                self.spawn(worker_id)
+
+    def spawn(self, worker_id):
+        """Fork a worker running serve(worker_id)."""
+        self.start_times[worker_id] = time.time()
+        pid = os.fork()
+        if pid != 0:
+            self.children[pid] = worker_id
+            return
+
+        status = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            #Don't share the database connections of the supervisor, if it
+            #has opened any.
+            model.dispose_engines()
+            serve(worker_id, self.sockets)
+        except Exception:
+            logging.exception('Worker %d failed.', worker_id)
+            status = 1
+        finally:
+            os._exit(status)
+
+    def handle_signal(self, signum, frame):
+        """Forward the signal to the workers and stop respawning them."""
+        self.stopping = True
+        for pid in self.children:
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                #It has exited.
+                pass
+
+
+def main():
+    """Main fuction which will start the HTTPServer (or the workers).
+
+    It also clean context finally. If you use the blog without start the main
+    fuction, please invoke the prepare and clean function yourself.
+    """
+    blog.bootstrap()
+    log.enable_pretty_logging()
+
+    #No worker is running, so the templates compiled by the previous
+    #versions can be removed.
+    context.prune_template_modules(context.init_context().template_lookup)
+
+    workers = options.server_workers
+    if workers <= 0:
+        workers = process.cpu_count()
+
+    if workers == 1:
+        print 'HTTPServer listening {0} will start now.'.format(
+            options.server_port)
+        serve(0, bind_sockets(options.server_port, options.server_address))
+        return
+
+    if options.session_storage == 'memory' and options.session_mode != 'cookie':
+        logging.warning('Every worker keeps its own sessions in memory, so a '
+                        'visitor will lose the session when the requests go '
+                        'to another worker. Use the sqlite session_storage '
+                        'or the cookie session_mode with more workers.')
+
+    sockets = None
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        sockets = bind_sockets(options.server_port, options.server_address)
+
+    print 'HTTPServer listening {0} will start in {1} workers now.'.format(
+        options.server_port, workers)
+    Supervisor(workers, sockets).run()
+
 if __name__ == '__main__':
     main()
@@ -1,48 +1,480 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+"""Sessions and the storages keeping them.
 
+A SessionManager keeps its sessions in a SessionStorage. MemorySessionStorage
+keeps them in the dict of this process, SQLiteSessionStorage keeps them in a
+SQLite file which the processes on one host can share.
+
+A small session can be kept by the visitor instead: encode_session turns it
+into a string for a signed cookie, and decode_session turns it back. Such a
+session has no key and is never put in the storage.
+"""
+
+import base64
 import datetime
-import random
-import string
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+from concurrent import futures
+import tornado.ioloop
+
+
+class SessionStorage(object):
+    """The interface of the session storages.
+
+    A storage works like a dict mapping the keys to the Session objects. The
+    storages persisting sessions require the values of sessions encodable in
+    JSON.
+    """
+    def __contains__(self, key):
+        raise NotImplementedError()
+
+    def __getitem__(self, key):
+        raise NotImplementedError()
+
+    def __setitem__(self, key, session):
+        raise NotImplementedError()
+
+    def __delitem__(self, key):
+        raise NotImplementedError()
+
+    def __len__(self):
+        raise NotImplementedError()
+
+    def get(self, key, default=None):
+        """Return the session with key, or default if there is no such one."""
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def set_many(self, sessions):
+        """Store some sessions at once.
+
+        args:
+            sessions(iterable of Session):
+                The sessions to store, with their keys.
+        """
+        for session in sessions:
+            self[session.key] = session
+
+    def clean_expired(self):
+        """Delete all expired sessions in the storage."""
+        raise NotImplementedError()
+
+    def close(self):
+        """Release the resource used by the storage."""
+        pass
+
+
+class ExpiryIndex(object):
+    """Index keys by when they expire, so the expired ones are found cheaply.
+
+    It is a timing wheel: the time is cut into slots of granularity seconds
+    and every key is put in the slot of its expire time. Adding, moving and
+    removing a key are O(1), and pop_expired only visits the slots passed
+    since the last call, so it costs as much as the keys expiring.
+    """
+    def __init__(self, granularity=60):
+        """
+        args:
+            granularity(int, default=60):
+                How many seconds a slot covers. A key may be popped up to
+                granularity seconds after it expires.
+        """
+        self.granularity = granularity
+        self.slots = dict()
+        self.slot_of = dict()
+        #No slot before next_slot has any key.
+        self.next_slot = None
+
+    def __len__(self):
+        return len(self.slot_of)
+
+    def add(self, key, timestamp):
+        """Add the key, or move it if it has been added.
+
+        args:
+            key(hashable):
+                The key.
+            timestamp(float):
+                When the key expires. A POSIX timestamp.
+        """
+        slot = int(timestamp // self.granularity)
+        old_slot = self.slot_of.get(key)
+        if old_slot == slot:
+            return
+        if old_slot is not None:
+            self._remove(key, old_slot)
+        self.slots.setdefault(slot, set()).add(key)
+        self.slot_of[key] = slot
+        if self.next_slot is None or slot < self.next_slot:
+            self.next_slot = slot
+
+    def discard(self, key):
+        """Remove the key if it has been added."""
+        slot = self.slot_of.get(key)
+        if slot is not None:
+            self._remove(key, slot)
+
+    def pop_earliest(self):
+        """Remove and return a key of the earliest slot, or None if empty."""
+        while self.slots:
+            keys = self.slots.get(self.next_slot)
+            if keys:
+                key = keys.pop()
+                if not keys:
+                    del self.slots[self.next_slot]
+                del self.slot_of[key]
+                return key
+            self.next_slot += 1
+        return None
+
+    def pop_expired(self, timestamp):
+        """Remove and return the keys expiring before the slot of timestamp.
+
+        args:
+            timestamp(float):
+                The POSIX timestamp of now.
+        return(list):
+            The expired keys.
+        """
+        end = int(timestamp // self.granularity)
+        expired = []
+        slot = self.next_slot
+        while slot is not None and slot < end:
+            keys = self.slots.pop(slot, ())
+            for key in keys:
+                del self.slot_of[key]
+            expired.extend(keys)
+            slot += 1
+        if self.next_slot is not None and self.next_slot < end:
+            self.next_slot = end
+        return expired
+
+    def _remove(self, key, slot):
+        """Remove the key from its slot."""
+        keys = self.slots[slot]
+        keys.discard(key)
+        if not keys:
+            del self.slots[slot]
+        del self.slot_of[key]
+
+
+class MemorySessionStorage(SessionStorage):
+    """Store the sessions in a dict of this process.
+
+    The sessions are lost when the process exits, and can't be shared with
+    other processes. The keys are indexed by the expire time, so cleaning
+    doesn't scan every session. Store a session again after refreshing it to
+    update the index.
+
+    The storage can be bounded by the count and the approximate bytes of the
+    sessions. When a bound is exceeded, the sessions expiring first are
+    evicted. A session is refreshed every time it is used, so they are the
+    least recently used ones (within the granularity of the index).
+
+    It isn't thread safe. Use it on the IOLoop only.
+    """
+    def __init__(self, granularity=60, max_entries=0, max_bytes=0):
+        """
+        args:
+            granularity(int, default=60):
+                The granularity of the ExpiryIndex in seconds.
+            max_entries(int, default=0):
+                How many sessions can be stored at most. 0 means no limit.
+            max_bytes(int, default=0):
+                How many bytes the sessions can take approximately. 0 means
+                no limit.
+        """
+        self.sessions = dict()
+        self.expiry = ExpiryIndex(granularity)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        return key in self.sessions
+
+    def __getitem__(self, key):
+        return self.sessions[key]
+
+    def __setitem__(self, key, session):
+        old = self.sessions.get(key)
+        if old is not None:
+            self.bytes -= old.size
+        self.sessions[key] = session
+        session.size = _approximate_size(session)
+        self.bytes += session.size
+        self.expiry.add(key, session.expire_time)
+        self._evict()
 
-import tornado.util
+    def __delitem__(self, key):
+        session = self.sessions.pop(key)
+        self.bytes -= session.size
+        self.expiry.discard(key)
 
+    def __len__(self):
+        return len(self.sessions)
+
+    def clean_expired(self):
+        """Delete the expired sessions found by the expiry index."""
+        for key in self.expiry.pop_expired(time.time()):
+            session = self.sessions.pop(key, None)
+            if session is not None:
+                self.bytes -= session.size
+
+    def stats(self):
+        """Return a dict of the entries, evictions and approximate bytes."""
+        return dict(entries=len(self.sessions),
+                    evictions=self.evictions,
+                    bytes=self.bytes,
+                    )
+
+    def _evict(self):
+        """Evict the sessions expiring first until the bounds are met."""
+        while ((self.max_entries and len(self.sessions) > self.max_entries) or
+               (self.max_bytes and self.bytes > self.max_bytes)):
+            key = self.expiry.pop_earliest()
+            if key is None:
+                break
+            self.bytes -= self.sessions.pop(key).size
+            self.evictions += 1
 
-class SessionStorage(dict):
-    """The class store sessions."""
-    pass
+
+#The bytes taken by a dict item and the ExpiryIndex for a session, roughly.
+_INDEX_OVERHEAD = 160
+
+
+def _approximate_size(session):
+    """Return roughly how many bytes the session takes, with its key."""
+    size = (sys.getsizeof(session) + sys.getsizeof(session.key) +
+            sys.getsizeof(session.expire_time) + sys.getsizeof(session.value) +
+            _INDEX_OVERHEAD)
+    for key, value in session.value.iteritems():
+        size += sys.getsizeof(key) + sys.getsizeof(value)
+    return size
+
+
+class SQLiteSessionStorage(SessionStorage):
+    """Store the sessions in a SQLite database file.
+
+    The processes on one host can share the file at the same time. It uses
+    the WAL journal, so reading doesn't wait for the other processes writing.
+    The writes are done by a thread of the storage with its own connection,
+    so the IOLoop never waits for the lock of the file, and the sessions
+    being written are got from the memory until they are written. Getting a
+    session returns a new Session object, store it again after modifying it.
+    The values of the sessions are stored in JSON.
+    """
+    def __init__(self, path, timeout=5.0, read_timeout=0.1):
+        """
+        args:
+            path(str):
+                The path of the database file. It will be created if it
+                doesn't exist.
+            timeout(float, default=5.0):
+                How many seconds the writing thread waits when another
+                process is writing.
+            read_timeout(float, default=0.1):
+                How many seconds a read waits if the file is busy, which is
+                rare in WAL mode.
+        """
+        self.path = path
+        self.timeout = timeout
+        #Guard the reading connection and the pending writes.
+        self.lock = threading.Lock()
+        #The key to (the version, the session) being written. The session is
+        #None if it is being deleted.
+        self.pending = dict()
+        self.versions = itertools.count()
+        #The thread writing, created on the first write.
+        self.writer = None
+        self.write_connection = None
+        self.connection = self._connect(path, read_timeout)
+        with self.lock:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS sessions ('
+                                    'key TEXT PRIMARY KEY, '
+                                    'expire_time REAL NOT NULL, '
+                                    'value BLOB NOT NULL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS '
+                                    'sessions_expire_time '
+                                    'ON sessions (expire_time)')
+
+    def __contains__(self, key):
+        with self.lock:
+            if key in self.pending:
+                return self.pending[key][1] is not None
+            return self.connection.execute(
+                'SELECT 1 FROM sessions WHERE key = ?',
+                (key, )).fetchone() is not None
+
+    def __getitem__(self, key):
+        with self.lock:
+            if key in self.pending:
+                session = self.pending[key][1]
+                if session is None:
+                    raise KeyError(key)
+                return Session(key, session.expire_time, session.value)
+            row = self.connection.execute('SELECT expire_time, value '
+                                          'FROM sessions WHERE key = ?',
+                                          (key, )).fetchone()
+        if row is None:
+            raise KeyError(key)
+        expire_time, value = row
+        try:
+            value = json.loads(value)
+        except ValueError:
+            logging.error('A session in %s can not be decoded, delete it.',
+                          self.path)
+            del self[key]
+            raise KeyError(key)
+        return Session(key, expire_time, value)
+
+    def __setitem__(self, key, session):
+        self.set_many([session])
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        with self.lock:
+            version = next(self.versions)
+            self.pending[key] = (version, None)
+        self._submit('DELETE FROM sessions WHERE key = ?', [(key, )],
+                     [(key, version)])
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute(
+                'SELECT COUNT(*) FROM sessions').fetchone()[0]
+
+    def set_many(self, sessions):
+        """Store some sessions in one transaction on the writing thread.
+
+        raise:
+            TypeError or ValueError: if a value can't be encoded in JSON.
+        """
+        rows = []
+        versions = []
+        with self.lock:
+            for session in sessions:
+                value = json.dumps(session.value, separators=(',', ':'))
+                rows.append((session.key, session.expire_time, value))
+                version = next(self.versions)
+                self.pending[session.key] = (version, session)
+                versions.append((session.key, version))
+        if rows:
+            self._submit('INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)',
+                         rows, versions)
+
+    def clean_expired(self):
+        """Delete all expired sessions on the writing thread. The index on
+        expire_time is used.
+        """
+        self._submit('DELETE FROM sessions WHERE expire_time < ?',
+                     [(time.time(), )], [])
+
+    def close(self):
+        """Finish the writes and close the connections."""
+        if self.writer is not None:
+            self.writer.shutdown()
+            self.writer = None
+            self.write_connection.close()
+        with self.lock:
+            self.connection.close()
+
+    def _connect(self, path, timeout):
+        """Open a connection to the database file."""
+        connection = sqlite3.connect(path,
+                                     timeout=timeout,
+                                     isolation_level=None,
+                                     check_same_thread=False,
+                                     )
+        connection.text_factory = str
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    def _submit(self, sql, rows, versions):
+        """Execute the statement for the rows in one transaction on the
+        writing thread, create it if necessary.
+        """
+        if self.writer is None:
+            self.write_connection = self._connect(self.path, self.timeout)
+            self.writer = futures.ThreadPoolExecutor(1)
+        self.writer.submit(self._write, sql, rows, versions)
+
+    def _write(self, sql, rows, versions):
+        """Run on the writing thread. Forget the pending writes when done.
+
+        args:
+            versions(list of tuple):
+                (key, version) of the pending writes done by the statement.
+        """
+        connection = self.write_connection
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                connection.executemany(sql, rows)
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+        except Exception:
+            logging.exception('Failed to write %d sessions to %s.',
+                              len(rows), self.path)
+        finally:
+            with self.lock:
+                for key, version in versions:
+                    if self.pending.get(key, (None, ))[0] == version:
+                        del self.pending[key]
 
 
 class Session(object):
-    """The session. Store a value and a expire_time."""
+    """The session. Store a value and a expire_time.
+
+    There may be millions of sessions, so it is kept compact: it has no
+    __dict__ and the expire_time is a float.
+    """
+    __slots__ = ('key', 'expire_time', 'value', 'size')
+
     def __init__(self, key, expire_time, value=None):
         """
         args:
-            expire_time(datetime.datetime):
-                When the session expire. UTC time.
+            expire_time(float):
+                When the session expire. A POSIX timestamp.
             key(str):
                 The key of the session in it's SessionStorage.
             value(dict, default=None):
-                Use value to init a ObjectDict as self.value. If it is None,
-                use an empty dict.
+                The value of the session. If it is None, use an empty dict.
         """
         self.key = key
         self.expire_time = expire_time
-        self.value = tornado.util.ObjectDict(value or dict())
+        self.value = value if value is not None else dict()
+        #The approximate bytes accounted by MemorySessionStorage.
+        self.size = 0
 
     def expired(self):
         """If this session expired?
         return(bool):
             If the session expired?
         """
-        return datetime.datetime.utcnow() > self.expire_time
+        return time.time() > self.expire_time
 
     def reset_expire_time(self, expire_time):
         """Reset the Session expire time.
 
         args:
-            expire(datetime.datetime):
-                When the session should be expired.
+            expire(float):
+                When the session should be expired. A POSIX timestamp.
         """
         self.expire_time = expire_time
 
@@ -50,30 +482,90 @@ class Session(object):
 class SessionManager(object):
     """The object manage session.
 
-    Use a SessionManager's storage attribute to visit a session.
+    Use get_session to visit a session, and save_session to store it after
+    modifying it. The saved sessions are written to the storage together on
+    the next iteration of the IOLoop.
     """
     def __init__(self,
                  default_expire=datetime.timedelta(hours=1),
-                 storage=SessionStorage,
+                 storage=MemorySessionStorage,
                  ):
         """
         args:
             default_expire(datetime.timedelta):
                 The default life time of a session. self.create_session will use
                 this as the default life time as a new session.
-            storage(type):
-                The storage class of the SessionManager. Must look like a
-                tornado.util.ObjectDict.
+            storage(type or SessionStorage):
+                The storage of the SessionManager. If it is a class, use an
+                instance created without args.
         """
         self.default_expire = default_expire
-        self.storage = SessionStorage()
+        if isinstance(storage, type):
+            storage = storage()
+        self.storage = storage
+        #The sessions saved but not written to the storage yet.
+        self.dirty = dict()
+        self.flush_scheduled = False
 
-    def create_session(self, value=None, expire=None):
-        """Create a new Session stored in self.storage.
+    def get_session(self, key):
+        """Return the session with key, or None if there is no such one.
+
+        args:
+            key(str): the key of the session.
+        """
+        if key is None:
+            return None
+        if key in self.dirty:
+            return self.dirty[key]
+        return self.storage.get(key)
+
+    def save_session(self, session):
+        """Save the session. It will be written to the storage soon.
+
+        The sessions saved during one iteration of the IOLoop are written in
+        one batch by flush.
+        args:
+            session(Session): the session you want to save.
+        """
+        self.dirty[session.key] = session
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            tornado.ioloop.IOLoop.current().add_callback(self.flush)
+
+    def flush(self):
+        """Write the saved sessions to the storage."""
+        self.flush_scheduled = False
+        dirty, self.dirty = self.dirty, dict()
+        if dirty:
+            self.storage.set_many(dirty.itervalues())
+
+    def new_key(self):
+        """Return a new key for the storage.
+
+        Will use 15 random bytes encoded in urlsafe base64 as storage's key. It
+        will guarantee the key is unique.
+        """
+        while True:
+            key = base64.urlsafe_b64encode(os.urandom(15))
+            if key not in self.dirty and key not in self.storage:
+                return key
+
+    def new_session(self, value=None, expire=None):
+        """Create a new Session without a key. It won't be saved.
 
-        Will use str(datetime.datetime.utcnow()) + [a random string consists
-        of 10 ascii letters] as storage's key. It will guarantee the key is
-        unique.
+        args:
+            value(dict, default=None):
+                The value of the new session. If it is None, use an empty dict.
+            expire(datetime.timedelta, default=None):
+                The life time of the new session. If it is None, will use the
+                manager's default_expire.
+        return(Session).
+        """
+        expire = expire or self.default_expire
+        return Session(None, time.time() + expire.total_seconds(), value)
+
+    def create_session(self, value=None, expire=None):
+        """Create a new Session with a new key and save it.
         args:
             value(dict, default=None):
                 The value of the new session. If it is None, use an empty dict.
@@ -83,19 +575,9 @@ class SessionManager(object):
         return((str, Session)):
             A tuple like (key, Created session)
         """
-        value = value or dict()
-        expire = expire or self.default_expire
-
-        create_time = datetime.datetime.utcnow()
-
-        #Get a new key.
-        while True:
-            key = ''.join([str(create_time)] +
-                          random.sample(string.ascii_letters, 10))
-            if key not in self.storage:
-                break
-        session = Session(key, create_time + expire, value)
-        self.storage[key] = session
+        session = self.new_session(value, expire)
+        session.key = self.new_key()
+        self.save_session(session)
         return session
 
     def refresh_session(self, key, expire=None):
@@ -108,23 +590,95 @@ class SessionManager(object):
         raise:
             KeyError: if there is no session with the key. Raise a KeyError.
         """
-        if key not in self.storage:
+        session = self.get_session(key)
+        if session is None:
             raise KeyError(('SessionStorage have'
                             'no session with key {0}').format(key))
         else:
-            expire = expire or self.default_expire
-            now = datetime.datetime.utcnow()
-            self.storage[key].reset_expire_time(now + expire)
+            self.refresh(session, expire)
+
+    def refresh(self, session, expire=None):
+        """Reset the expire_time of the session to utcnow + expire and save it.
+
+        args:
+            session(Session):
+                The session to refresh.
+            expire(datetime.timedelta, default=None):
+                The life time of the session after refresh. Will use the
+                default_expire of SessionManager if it is None.
+        """
+        self.touch(session, expire)
+        self.save_session(session)
+
+    def touch(self, session, expire=None):
+        """Reset the expire_time of the session to utcnow + expire.
+
+        Unlike refresh, it doesn't save the session.
+        args:
+            session(Session):
+                The session to touch.
+            expire(datetime.timedelta, default=None):
+                The life time of the session after touching. Will use the
+                default_expire of SessionManager if it is None.
+        """
+        expire = expire or self.default_expire
+        session.reset_expire_time(time.time() + expire.total_seconds())
+
+    def encode_session(self, session):
+        """Encode the expire_time and the value of the session in a string.
+
+        args:
+            session(Session):
+                The session to encode.
+        return(str or None):
+            The JSON string, or None if the value can't be encoded in JSON.
+        """
+        try:
+            return json.dumps(dict(e=session.expire_time, v=session.value),
+                              separators=(',', ':'))
+        except (TypeError, ValueError):
+            return None
+
+    def decode_session(self, data):
+        """Decode a session encoded by encode_session.
+
+        args:
+            data(str):
+                The string returned by encode_session.
+        return(Session or None):
+            The session without key, or None if data is malformed or the
+            session has expired.
+        """
+        try:
+            data = json.loads(data)
+            session = Session(None, float(data['e']), dict(data['v']))
+        except (TypeError, ValueError, KeyError):
+            return None
+        if session.expired():
+            return None
+        return session
 
     def del_session(self, key):
         """Delete a session.
         args:
             key(str): the key of the session you want to delete.
         """
-        del self.storage[key]
+        saved = self.dirty.pop(key, None)
+        try:
+            del self.storage[key]
+        except KeyError:
+            if saved is None:
+                raise
 
     def clean_expired_session(self):
-        """Delete all expire session in the storage."""
-        for key, session in self.storage.copy().iteritems():
-            if session.expired():
-                del self.storage[key]
+        """Delete all expire session in the storage.
+
+        The storage may not be thread safe. Call it on the IOLoop thread, such
+        as by IOLoop.add_callback from the Cron runner.
+        """
+        self.storage.clean_expired()
+
+    def close(self):
+        """Write the saved sessions and close the storage."""
+        self.flush()
+        self.storage.close()